@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+
+from qdo.log import get_logger
+from qdo.log import log_raven
+
+
+class CheckpointWriter(object):
+    """Writes partition checkpoints to their checkpoint store in a
+    background thread, so the job loop doesn't have to wait for the writes.
+
+    Only the latest pending message id is kept for each partition. Pending
+    checkpoints which the checkpoint store can save together, like those of
+    partitions sharing a grouped status record, are written with a single
+    request. If more than `max_pending` partitions are waiting to be
+    written, the writer has fallen behind and :py:meth:`submit` blocks until
+    it caught up.
+
+    :param max_pending: Maximum number of partitions with a pending
+        checkpoint, defaults to 1000.
+    :type max_pending: int
+    """
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._pending = {}
+        self._writing = 0
+        self._paused = False
+        self._stopped = True
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Write all pending checkpoints and stop the background thread."""
+        self.flush()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, partition, value):
+        """Schedule a checkpoint to be written for a partition.
+
+        :param partition: The partition.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :param value: The message id of the last processed message.
+        :type value: unicode
+        """
+        with self._cond:
+            if self._full(partition):
+                get_logger().incr('worker.checkpoint_backpressure')
+                # flush swaps in a new dict, so look it up after each wait
+                while self._full(partition):
+                    self._cond.wait()
+            self._pending[partition.name] = (partition, value)
+            self._cond.notify_all()
+
+    def _full(self, partition):
+        pending = self._pending
+        return partition.name not in pending and \
+            len(pending) >= self.max_pending
+
+    def flush(self):
+        """Write all pending checkpoints in the calling thread and return
+        once they have been written.
+        """
+        with self._cond:
+            self._paused = True
+            # wait for a concurrent write to finish, to keep the order
+            while self._writing:
+                self._cond.wait()
+            pending = self._pending
+            self._pending = {}
+        try:
+            while pending:
+                group = take_group(pending)
+                try:
+                    write_checkpoints(group)
+                except Exception:
+                    with self._cond:
+                        # keep the unwritten checkpoints, unless a newer
+                        # value has been submitted
+                        for partition, value in group:
+                            self._pending.setdefault(
+                                partition.name, (partition, value))
+                        for name, item in pending.items():
+                            self._pending.setdefault(name, item)
+                    raise
+        finally:
+            with self._cond:
+                self._paused = False
+                self._cond.notify_all()
+
+    def _run(self):
+        cond = self._cond
+        while 1:
+            with cond:
+                while self._paused or not (self._pending or self._stopped):
+                    cond.wait()
+                if not self._pending:
+                    # stopped and nothing left to do
+                    return
+                group = take_group(self._pending)
+                self._writing += 1
+                cond.notify_all()
+            try:
+                write_checkpoints(group)
+            except Exception:
+                log_raven()
+                with cond:
+                    # retry later, unless a newer value has been submitted
+                    for partition, value in group:
+                        self._pending.setdefault(
+                            partition.name, (partition, value))
+                    cond.wait(1.0)
+            finally:
+                with cond:
+                    self._writing -= 1
+                    cond.notify_all()
+
+
+def take_group(pending):
+    """Remove and return a list of pending checkpoints, which can be saved
+    together, as they share the same checkpoint store and group key.
+
+    :param pending: A mapping of partition names to tuples of partition and
+        message id.
+    :type pending: dict
+    :rtype: list
+    """
+    name, (partition, value) = pending.popitem()
+    group = [(partition, value)]
+    store = partition.store
+    key = store.group_key(partition)
+    if key != partition.name:
+        for name, (other, value) in pending.items():
+            if other.store is store and store.group_key(other) == key:
+                del pending[name]
+                group.append((other, value))
+    return group
+
+
+def write_checkpoints(group):
+    """Save a group of checkpoints, as returned by :py:func:`take_group`.
+
+    :param group: A list of tuples of partition and message id.
+    :type group: list
+    """
+    group[0][0].store.save(group)
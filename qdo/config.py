@@ -254,16 +254,41 @@ class QdoSettings(SettingsDict):
         """Populate settings with default values"""
         self['qdo-worker.name'] = ''
         self['qdo-worker.wait_interval'] = 30
+        self['qdo-worker.batch_size'] = 20
+        self['qdo-worker.concurrency'] = 1
+        self['qdo-worker.fetch_concurrency'] = 1
+        self['qdo-worker.prefetch_budget'] = 0
+        self['qdo-worker.checkpoint_every_messages'] = 1
+        self['qdo-worker.checkpoint_every_seconds'] = 0
+        self['qdo-worker.checkpoint_async'] = False
+        self['qdo-worker.checkpoint_max_pending'] = 1000
+        self['qdo-worker.checkpoint_format'] = 'partition'
+        self['qdo-worker.status_partitions'] = STATUS_PARTITIONS
+        self['qdo-worker.checkpoint_store'] = 'queuey'
+        self['qdo-worker.checkpoint_path'] = None
+        self['qdo-worker.checkpoint_journal'] = None
+        self['qdo-worker.checkpoint_journal_sync'] = 0
+        self['qdo-worker.partition_cache_size'] = 0
+        self['qdo-worker.status_compact_interval'] = 0
         self['qdo-worker.ca_bundle'] = None
         self['qdo-worker.job'] = None
+        self['qdo-worker.job_batch'] = None
         self['qdo-worker.job_context'] = 'qdo.worker:dict_context'
         self['qdo-worker.job_failure'] = 'qdo.worker:log_failure'
 
         self['partitions.policy'] = 'manual'
         self['partitions.ids'] = []
+        self['partitions.discovery_interval'] = 0
+        self['partitions.include'] = []
+        self['partitions.exclude'] = []
+        self['partitions.max_weight'] = 1
+        self['partitions.weights'] = []
 
         self['queuey.connection'] = 'http://127.0.0.1:5000/v1/queuey/'
         self['queuey.app_key'] = None
+        self['queuey.metadata_ttl'] = 0
+        self['queuey.pool_size'] = 0
+        self['queuey.eject_time'] = 30
 
         self['zookeeper.connection'] = ZOO_DEFAULT_CONN
         self['zookeeper.party_wait'] = 10
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+import fnmatch
+import re
+import sys
+
+
+class Job(object):
+    """The set of hooks used to process the messages of some queues.
+
+    :param name: The job name.
+    :type name: str
+    :param job: The job function, called with a single message.
+    :type job: callable
+    :param job_batch: The batch job function, called with a list of
+        messages. Used instead of `job`, if given.
+    :type job_batch: callable
+    :param job_context: The job context manager.
+    :type job_context: callable
+    :param job_failure: The job failure handler.
+    :type job_failure: callable
+    :param queues: Queue names or glob patterns of the queues this job
+        handles.
+    :type queues: list
+    """
+
+    def __init__(self, name, job=None, job_batch=None, job_context=None,
+                 job_failure=None, queues=()):
+        self.name = name
+        self.job = job
+        self.job_batch = job_batch
+        self.job_context = job_context
+        self.job_failure = job_failure
+        self.queues = queues
+
+
+class JobTable(object):
+    """Maps queue names to jobs. The first job with a matching queue pattern
+    is used, or the default job, if none matches. Patterns are compiled once
+    and the result for each queue name is cached, so each queue is only
+    matched against the patterns once.
+
+    :param jobs: A list of jobs.
+    :type jobs: list
+    :param default: The default job, used for all queues not matching any
+        pattern.
+    :type default: :py:class:`Job`
+    """
+
+    def __init__(self, jobs, default=None):
+        self.jobs = list(jobs)
+        self.default = default
+        self._patterns = [(re.compile(fnmatch.translate(pattern)), job)
+            for job in self.jobs for pattern in job.queues]
+        self._table = {}
+
+    def __iter__(self):
+        if self.default is not None:
+            yield self.default
+        for job in self.jobs:
+            yield job
+
+    def get(self, queue_name):
+        """Returns the job for a queue or `None`.
+
+        :param queue_name: The queue name.
+        :type queue_name: str
+        :rtype: :py:class:`Job`
+        """
+        try:
+            return self._table[queue_name]
+        except KeyError:
+            job = self.default
+            for regex, candidate in self._patterns:
+                if regex.match(queue_name):
+                    job = candidate
+                    break
+            self._table[queue_name] = job
+            return job
+
+    def contexts(self):
+        """Returns a context manager, which enters the job context of every
+        job and provides a mapping of job names to the job contexts.
+        """
+        return job_contexts(list(self))
+
+
+def compile_patterns(patterns):
+    """Compile a list of queue names or glob patterns into a single
+    regular expression matching any of them. Returns `None` for an empty
+    list.
+
+    :param patterns: A list of queue names or glob patterns or a single
+        one.
+    :type patterns: list
+    """
+    if not patterns:
+        return None
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    return re.compile('|'.join(
+        ['(?:%s)' % fnmatch.translate(pattern) for pattern in patterns]))
+
+
+@contextmanager
+def job_contexts(jobs):
+    """Enter the job context of each job and yield a mapping of job names to
+    the job contexts. The job contexts are exited in reverse order.
+
+    :param jobs: A list of jobs.
+    :type jobs: list
+    """
+    contexts = {}
+    managers = []
+    try:
+        for job in jobs:
+            manager = job.job_context()
+            contexts[job.name] = manager.__enter__()
+            managers.append(manager)
+        yield contexts
+    except:
+        exc_info = sys.exc_info()
+        for manager in reversed(managers):
+            manager.__exit__(*exc_info)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    else:
+        for manager in reversed(managers):
+            manager.__exit__(None, None, None)
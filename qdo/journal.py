@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import os
+import os.path
+import threading
+import time
+
+from qdo.status import message_timestamp
+
+
+def read_journal(path):
+    """Returns a mapping of partition names to the id of their last
+    processed message, as recorded in a journal file. An incomplete last
+    line, left behind by a crash, is ignored.
+
+    :param path: The path of the journal file.
+    :type path: str
+    :rtype: dict
+    """
+    result = {}
+    try:
+        with open(path, 'rb') as journal:
+            for line in journal:
+                if not line.endswith('\n'):
+                    break
+                parts = line.split()
+                if len(parts) == 2:
+                    result[parts[0].decode('utf-8')] = \
+                        parts[1].decode('utf-8')
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    return result
+
+
+class CheckpointJournal(object):
+    """A local append-only journal of checkpoints. Checkpoints are recorded
+    for every processed message and synced to disk in batches, so the
+    checkpoint store can be written to less often, without replaying many
+    messages after a crash.
+
+    Each worker process appends to its own journal file inside a shared
+    directory. Once the file grows larger than `max_size`, it is replaced
+    with a file only holding the latest checkpoint of each partition.
+
+    :param directory: The directory holding the journal files.
+    :type directory: str
+    :param name: The name of this worker's journal file, without the
+        `.journal` extension.
+    :type name: str
+    :param sync_interval: Sync the journal file to disk if the last sync is
+        older than this many seconds, defaults to `0`, which syncs on every
+        recorded checkpoint.
+    :type sync_interval: float
+    :param max_size: Maximum size of the journal file in bytes, defaults
+        to 1 MB.
+    :type max_size: int
+    """
+
+    def __init__(self, directory, name, sync_interval=0, max_size=1 << 20):
+        self.directory = directory
+        self.path = os.path.join(directory, name + '.journal')
+        self.sync_interval = sync_interval
+        self.max_size = max_size
+        self._latest = {}
+        self._file = None
+        self._size = 0
+        self._synced = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Returns a mapping of partition names to the id of their last
+        processed message, read from all journal files in the directory.
+        The newest message id of each partition wins.
+
+        :rtype: dict
+        """
+        result = {}
+        if not os.path.isdir(self.directory):
+            return result
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.journal'):
+                continue
+            entries = read_journal(os.path.join(self.directory, filename))
+            for name, processed in entries.items():
+                if name not in result or message_timestamp(processed) > \
+                   message_timestamp(result[name]):
+                    result[name] = processed
+        return result
+
+    def open(self):
+        """Open the journal file for appending."""
+        with self._lock:
+            if self._file is not None:
+                return
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._latest = read_journal(self.path)
+            self._file = open(self.path, 'ab')
+            self._size = self._file.tell()
+            self._synced = time.time()
+
+    def record(self, name, value):
+        """Record a checkpoint.
+
+        :param name: The partition name.
+        :type name: unicode
+        :param value: The message id of the last processed message.
+        :type value: unicode
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._latest[name] = value
+            line = (u'%s %s\n' % (name, value)).encode('utf-8')
+            self._file.write(line)
+            self._size += len(line)
+            self._dirty = True
+            if self._size > self.max_size:
+                self._rotate()
+            elif time.time() - self._synced >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        """Sync all recorded checkpoints to disk."""
+        with self._lock:
+            if self._file is not None and self._dirty:
+                self._sync()
+
+    def close(self):
+        """Sync and close the journal file."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.time()
+        self._dirty = False
+
+    def _rotate(self):
+        # write the latest checkpoints to a new file and atomically replace
+        # the journal file with it
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as journal:
+            for name, value in self._latest.items():
+                journal.write((u'%s %s\n' % (name, value)).encode('utf-8'))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._file.close()
+        os.rename(temp, self.path)
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        self._synced = time.time()
+        self._dirty = False
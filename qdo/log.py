@@ -28,3 +28,11 @@ def configure(settings, debug=False):
         # don't reconfigure an already configured debug logger
         if not isinstance(logger.sender, DebugCaptureSender):
             get_client('qdo-worker', settings)
+
+
+def log_raven():
+    """Log the current exception using metlog-raven if it's configured."""
+    logger = get_logger()
+    raven = getattr(logger, 'raven', None)
+    if raven is not None:
+        raven()
@@ -3,13 +3,18 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from collections import deque
+import random
+import time
 import uuid
 
 from ujson import decode
 from ujson import encode
 
 from qdo.config import STATUS_PARTITIONS
-from qdo.config import STATUS_QUEUE
+from qdo.status import status_partition_for
+from qdo.status import status_url
+from qdo.store import QueueyStore
 
 
 class Partition(object):
@@ -22,15 +27,72 @@ class Partition(object):
         partition id, separated by a dash.
     :type name: str
     :param msgid: The key of the message in the status queue, holding
-        information about the processing state of this partition.
+        information about the processing state of this partition. Without
+        one, a new key is generated and the status message is only created
+        once the first checkpoint is written.
     :type msgid: unicode
     :param worker_id: An id for the current worker process, used for logging.
     :type name: unicode
+    :param batch_size: Number of messages to fetch at once into the local
+        message buffer, defaults to 20.
+    :type batch_size: int
+    :param last_message: The already known message id of the last processed
+        message. If it isn't given, it's read once from the status queue.
+    :type last_message: unicode
+    :param checkpoint_every_messages: Write the processing state to the
+        status queue after this many processed messages, defaults to 1.
+        `0` disables the limit.
+    :type checkpoint_every_messages: int
+    :param checkpoint_every_seconds: Write the processing state to the
+        status queue if the oldest unsaved update is older than this many
+        seconds, defaults to `0`, which disables the limit.
+    :type checkpoint_every_seconds: float
+    :param writer: An optional checkpoint writer, used to write checkpoints
+        in the background.
+    :type writer: :py:class:`qdo.checkpoint.CheckpointWriter`
+    :param wait_interval: Base interval in seconds for which an empty
+        partition isn't polled again. The interval doubles for each
+        consecutive empty poll up to a factor of 1024. Defaults to `0`.
+    :type wait_interval: float
+    :param records: Optional grouped status records. If given, checkpoints
+        are written into the status record of the partition's status
+        partition, instead of a status message of its own.
+    :type records: :py:class:`qdo.status.StatusRecords`
+    :param status_partitions: Number of partitions of the status queue,
+        defaults to 7.
+    :type status_partitions: int
+    :param store: The checkpoint store, defaults to a
+        :py:class:`qdo.store.QueueyStore`, writing to the status queue.
+    :type store: :py:class:`qdo.store.CheckpointStore`
+    :param journal: An optional local checkpoint journal, which records
+        every processed message.
+    :type journal: :py:class:`qdo.journal.CheckpointJournal`
     """
 
-    def __init__(self, queuey_conn, name, msgid=None, worker_id=''):
+    def __init__(self, queuey_conn, name, msgid=None, worker_id='',
+                 batch_size=20, last_message=None,
+                 checkpoint_every_messages=1, checkpoint_every_seconds=0,
+                 writer=None, wait_interval=0, records=None,
+                 status_partitions=STATUS_PARTITIONS, store=None,
+                 journal=None):
         self.queuey_conn = queuey_conn
         self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.checkpoint_every_messages = checkpoint_every_messages
+        self.checkpoint_every_seconds = checkpoint_every_seconds
+        self.writer = writer
+        self.wait_interval = wait_interval
+        self.records = records
+        self.store = QueueyStore() if store is None else store
+        self.journal = journal
+        self.idle = 0
+        self.next_poll = 0
+        self.last_active = 0
+        self._buffer = deque()
+        self._cursor = None
+        self._last_message = last_message
+        self._unsaved = 0
+        self._unsaved_since = None
         if '-' in name:
             self.name = name
             parts = name.split('-')
@@ -39,19 +101,20 @@ class Partition(object):
             self.name = name + '-1'
             self.queue_name, self.partition = (name, 1)
         # map partition to one in 1 to max status partitions
-        self.status_partition = ((self.partition - 1) % STATUS_PARTITIONS) + 1
+        self.status_partition = status_partition_for(
+            self.partition, status_partitions)
         self.msgid = msgid
         if msgid is None:
-            self.msgid = uuid.uuid1().hex
-            self._create_status_message()
+            if records is None:
+                # the status message is created by the first checkpoint
+                self.msgid = uuid.uuid1().hex
+            if last_message is None:
+                # a new partition without any checkpoint
+                self._last_message = ''
 
     @property
     def _status_url(self):
-        sp = unicode(self.status_partition)
-        return STATUS_QUEUE + '/' + sp + '%3A' + self.msgid
-
-    def _create_status_message(self):
-        return self._update_status_message('')
+        return status_url(self.status_partition, self.msgid)
 
     def _get_status_message(self):
         response = self.queuey_conn.get(self._status_url)
@@ -61,6 +124,9 @@ class Partition(object):
         return None
 
     def _update_status_message(self, value):
+        if self.records is not None:
+            return self.records.write(
+                self.status_partition, {self.name: value})
         result = self.queuey_conn.put(self._status_url, data=encode(dict(
             partition=self.name, processed=value, last_worker=self.worker_id)),
             headers={'X-TTL': '2592000'},  # thirty days
@@ -82,20 +148,147 @@ class Partition(object):
             partition=self.partition, since=self.last_message, limit=limit,
             order=order)
 
+    @property
+    def buffered(self):
+        """The number of locally buffered messages."""
+        return len(self._buffer)
+
+    def fetch(self, low_water=0):
+        """Fetches the next batch of up to :py:attr:`batch_size` messages
+           into the local message buffer, if it holds no more than
+           `low_water` messages.
+
+        :param low_water: Only fetch if at most this many messages are
+            buffered, defaults to 0.
+        :type low_water: int
+        :raises: :py:exc:`queuey_py.HTTPError`
+        :returns: The number of buffered messages.
+        :rtype: int
+        """
+        buffer = self._buffer
+        if len(buffer) <= low_water:
+            # continue after the last buffered message
+            since = self._cursor or self.last_message
+            limit = self.batch_size
+            if since:
+                # Queuey includes the `since` message in its response, ask
+                # for one more message to account for it being filtered out
+                limit += 1
+            messages = self.queuey_conn.messages(self.queue_name,
+                partition=self.partition, since=since, limit=limit)
+            if messages:
+                self._cursor = messages[-1]['message_id']
+                buffer.extend(messages)
+            self._backoff(not buffer)
+        return len(buffer)
+
+    def _backoff(self, empty):
+        if not empty:
+            self.idle = 0
+            self.next_poll = 0
+            self.last_active = time.time()
+            return
+        jitter = random.uniform(0.8, 1.2)
+        self.next_poll = time.time() + \
+            self.wait_interval * jitter * 2 ** min(self.idle, 10)
+        self.idle += 1
+
+    def due(self, now=None):
+        """Returns `True` if the partition has buffered messages or should
+           be polled for new messages, as it isn't backing off anymore.
+
+        :param now: The current time, defaults to :py:func:`time.time`.
+        :type now: float
+        :rtype: bool
+        """
+        if self._buffer:
+            return True
+        if now is None:
+            now = time.time()
+        return self.next_poll <= now
+
+    def next_message(self, fetch=True):
+        """Returns the next unprocessed message for the partition or `None`
+           if there is none. Messages are fetched in batches of
+           :py:attr:`batch_size` and buffered locally, so only every
+           n-th call results in a request to Queuey.
+
+        :param fetch: If `False`, only return an already buffered message,
+            defaults to `True`.
+        :type fetch: bool
+        :raises: :py:exc:`queuey_py.HTTPError`
+        :rtype: dict
+        """
+        if fetch:
+            self.fetch()
+        if self._buffer:
+            return self._buffer.popleft()
+        return None
+
+    def next_messages(self, limit):
+        """Returns up to `limit` already buffered messages, without fetching
+           any new ones.
+
+        :param limit: Maximum number of messages.
+        :type limit: int
+        :rtype: list
+        """
+        buffer = self._buffer
+        messages = []
+        while buffer and len(messages) < limit:
+            messages.append(buffer.popleft())
+        return messages
+
     @property
     def last_message(self):
         """Property for the message id of the last processed message.
+
+        The worker owning the partition is the only one writing to its
+        status message, so the value is only read from Queuey once and
+        kept in memory afterwards.
         """
-        msg = self._get_status_message()
-        if msg is None:
-            return ''
-        return msg['processed']
+        if self._last_message is None:
+            msg = self._get_status_message()
+            self._last_message = '' if msg is None else msg['processed']
+        return self._last_message
 
     @last_message.setter
     def last_message(self, value):
-        """Sets the message id of the last processed message.
+        """Sets the message id of the last processed message. The value is
+        only written to the status queue once one of the checkpoint limits
+        is reached.
 
         :param value: New message id value.
         :type value: str
         """
-        self._update_status_message(value)
+        self._last_message = value
+        if self.journal is not None:
+            self.journal.record(self.name, value)
+        if not self._unsaved:
+            self._unsaved_since = time.time()
+        self._unsaved += 1
+        self.flush(force=False)
+
+    def flush(self, force=True):
+        """Writes the last processed message id to the status queue, if it
+        changed since the last write.
+
+        :param force: If `False`, only write the value if one of the
+            checkpoint limits has been reached, defaults to `True`.
+        :type force: bool
+        """
+        if not self._unsaved:
+            return
+        if not force:
+            every_messages = self.checkpoint_every_messages
+            every_seconds = self.checkpoint_every_seconds
+            if not ((every_messages and self._unsaved >= every_messages) or
+                    (every_seconds and time.time() - self._unsaved_since >=
+                        every_seconds)):
+                return
+        if self.writer is not None:
+            self.writer.submit(self, self._last_message)
+        else:
+            self.store.save([(self, self._last_message)])
+        self._unsaved = 0
+        self._unsaved_since = None
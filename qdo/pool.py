@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from Queue import Queue
+import sys
+import threading
+
+
+class JobPool(object):
+    """A fixed size pool of threads running jobs for multiple partitions in
+    parallel. Each thread enters its own job context, which is passed to
+    every task run by the thread.
+
+    At most one task runs for any given partition at a time, so messages of
+    one partition are still processed strictly in order.
+
+    :param size: Number of threads.
+    :type size: int
+    :param job_context: The job context manager, called once per thread.
+    :type job_context: callable
+    """
+
+    def __init__(self, size, job_context):
+        self.size = size
+        self.job_context = job_context
+        self._tasks = Queue()
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._error = None
+        self._threads = []
+
+    @property
+    def active(self):
+        """The number of partitions with a scheduled or running task."""
+        return len(self._busy)
+
+    def start(self):
+        """Start all threads."""
+        for i in xrange(self.size):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Wait for all scheduled tasks to finish and stop all threads."""
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._reraise()
+
+    def busy(self, name):
+        """Returns `True` if a task for the partition is scheduled or running.
+
+        :param name: The partition name.
+        :type name: str
+        :rtype: bool
+        """
+        return name in self._busy
+
+    def submit(self, name, func):
+        """Schedule a task for a partition.
+
+        :param name: The partition name.
+        :type name: str
+        :param func: The task, called with the job context as its only
+            argument.
+        :type func: callable
+        """
+        self._reraise()
+        with self._cond:
+            self._busy.add(name)
+        self._tasks.put((name, func))
+
+    def wait(self, timeout=None):
+        """Wait for any scheduled task to finish.
+
+        :param timeout: Maximum number of seconds to wait.
+        :type timeout: float
+        """
+        with self._cond:
+            if self._busy:
+                self._cond.wait(timeout)
+        self._reraise()
+
+    def join(self):
+        """Wait for all scheduled tasks to finish."""
+        with self._cond:
+            while self._busy:
+                self._cond.wait()
+        self._reraise()
+
+    def _reraise(self):
+        # re-raise an unexpected task exception in the calling thread
+        error, self._error = self._error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _run(self):
+        with self.job_context() as context:
+            while 1:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                name, func = task
+                try:
+                    func(context)
+                except Exception:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+                finally:
+                    with self._cond:
+                        self._busy.discard(name)
+                        self._cond.notify_all()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+from ujson import decode
+
+from qdo.log import get_logger
+
+
+class QueueCache(object):
+    """Caches the names and partition counts of all queues of an
+    application, so they don't have to be listed every time they are
+    needed.
+
+    Queuey can only list all queues at once, so the whole listing is
+    refreshed once it is older than the `ttl`. Queues created or resized by
+    the worker itself are recorded without listing all queues again.
+
+    :param queuey_conn: A
+        :py:class:`Queuey client <queuey_py.Client>` instance.
+    :type queuey_conn: object
+    :param ttl: Number of seconds the listing is used for, defaults to
+        `0`, which lists all queues every time.
+    :type ttl: float
+    """
+
+    def __init__(self, queuey_conn, ttl=0):
+        self.queuey_conn = queuey_conn
+        self.ttl = ttl
+        self._queues = None
+        self._expires = 0
+
+    def refresh(self):
+        """List all queues."""
+        with get_logger().timer('worker.list_queues'):
+            response = self.queuey_conn.get(params={'details': True})
+        queues = decode(response.text)['queues']
+        self._queues = [(q['queue_name'], q['partitions']) for q in queues]
+        self._expires = time.time() + self.ttl
+
+    def queues(self, refresh=False):
+        """Returns a list of tuples of queue name and number of partitions,
+        in the order listed by Queuey.
+
+        :param refresh: List all queues, even if the listing hasn't
+            expired yet.
+        :type refresh: bool
+        :rtype: list
+        """
+        if refresh or self._queues is None or time.time() >= self._expires:
+            self.refresh()
+        return list(self._queues)
+
+    def partitions(self, refresh=False):
+        """Returns the names of all partitions of all queues.
+
+        :param refresh: List all queues, even if the listing hasn't
+            expired yet.
+        :type refresh: bool
+        :rtype: list
+        """
+        partitions = []
+        for name, count in self.queues(refresh=refresh):
+            for i in xrange(1, count + 1):
+                partitions.append('%s-%s' % (name, i))
+        return partitions
+
+    def update(self, queue_name, partitions):
+        """Record a queue, which has been created or resized.
+
+        :param queue_name: The queue name.
+        :type queue_name: unicode
+        :param partitions: The number of partitions of the queue.
+        :type partitions: int
+        """
+        if self._queues is None:
+            return
+        for i, (name, count) in enumerate(self._queues):
+            if name == queue_name:
+                self._queues[i] = (name, partitions)
+                return
+        self._queues.append((queue_name, partitions))
+
+    def invalidate(self):
+        """Forget the listing, so it is refreshed on next use."""
+        self._queues = None
@@ -4,14 +4,18 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import errno
 import os
 import os.path
+import signal
 import sys
+import time
 
 import pkg_resources
 
 from qdo import log
 from qdo import worker
+from qdo.log import log_raven
 from qdo.config import load_into_settings
 from qdo.config import QdoSettings
 
@@ -35,6 +39,12 @@ def parse_args(args):
                         dest='configfile', default=DEFAULT_CONFIGFILE,
                         help='specify configuration file, defaults to '
                              '%s' % DEFAULT_CONFIGFILE)
+    parser.add_argument('-p', '--processes', action='store', type=int,
+                        dest='processes', default=1,
+                        help='number of worker processes, defaults to 1')
+    parser.add_argument('--compact-status', action='store_true',
+                        dest='compact_status', default=False,
+                        help='compact the status queue and exit')
     return parser.parse_args(args=args)
 
 
@@ -54,6 +64,97 @@ def parse_config(filename, settings):
     return config
 
 
+def _preload(settings):
+    # import all job code once, so forked children share it copy-on-write
+    hooks = ('job', 'job_batch', 'job_context', 'job_failure')
+    section = settings.getsection('qdo-worker')
+    for name in hooks:
+        if section[name]:
+            worker.resolve_spec(section[name])
+    for section in worker.job_sections(settings).values():
+        for name in hooks:
+            if section.get(name):
+                worker.resolve_spec(section[name])
+
+
+def _run_child(settings, index):
+    # the master forwards Ctrl-C to all children as SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # turn SIGTERM into SystemExit, so pending checkpoints get written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    identifier = settings['qdo-worker.name']
+    settings['qdo-worker.name'] = '%s-%s' % (identifier, index) \
+        if identifier else str(index)
+    code = 1
+    try:
+        qdo_worker = worker.Worker(settings)
+        try:
+            qdo_worker.work()
+            code = 0
+        except SystemExit as exc:
+            code = exc.code or 0
+        finally:
+            # os._exit skips the atexit hook of the worker
+            qdo_worker.stop()
+    except Exception:
+        log_raven()
+    finally:
+        os._exit(code)
+
+
+def run_processes(settings, processes):
+    """Fork `processes` worker processes and restart each of them if it
+    crashes. Returns once all of them have exited.
+    """
+    _preload(settings)
+    children = {}
+    stopping = []
+    master = os.getpid()
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            _run_child(settings, index)
+        children[pid] = index
+
+    def stop(signum, frame):
+        if os.getpid() != master:  # pragma: no cover
+            # a forked child, which hasn't installed its own handlers yet,
+            # must not signal its siblings
+            if signum == signal.SIGTERM:
+                os._exit(0)
+            return
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:  # pragma: no cover
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for index in xrange(processes):
+            spawn(index)
+        while children:
+            try:
+                pid, status = os.wait()
+            except OSError as exc:  # pragma: no cover
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            index = children.pop(pid)
+            if status != 0 and not stopping:
+                log.get_logger().incr('worker.process_restart')
+                # don't restart crashing children in a tight loop
+                time.sleep(1)
+                if not stopping:
+                    spawn(index)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+
 def run(args=sys.argv[1:]):
     arguments = parse_args(args)
     settings = QdoSettings()
@@ -61,5 +162,11 @@ def run(args=sys.argv[1:]):
     if config is None:
         print('Configuration file not found or cannot be read.')
         sys.exit(1)
-    worker.run(settings)
+    if arguments.compact_status:
+        deleted = worker.compact(settings)
+        print('Deleted %s status messages.' % deleted)
+    elif arguments.processes > 1:
+        run_processes(settings, arguments.processes)
+    else:
+        worker.run(settings)
     sys.exit(0)  # pragma: no cover
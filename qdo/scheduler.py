@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+class DeficitScheduler(object):
+    """A deficit round-robin scheduler, deciding how many messages each
+    partition may process during one pass over all partitions.
+
+    In each pass every partition with messages is credited with its weight
+    and may process as many messages as its accumulated credit allows.
+    Unused credit is carried over to the next pass, as long as the partition
+    has buffered messages left. As all weights are positive, every partition
+    with messages is served after a bounded number of passes, so no
+    partition starves.
+
+    The weight of a partition is either configured for its queue or derived
+    from its observed backlog: a partition with a full message buffer gets
+    the `max_weight`, an almost empty one a weight close to 1.
+
+    :param max_weight: The maximum weight derived from the backlog,
+        defaults to 1.
+    :type max_weight: int
+    :param weights: A mapping of queue names to configured weights.
+    :type weights: dict
+    """
+
+    def __init__(self, max_weight=1, weights=None):
+        self.max_weight = max_weight
+        self.weights = weights or {}
+        self._deficit = {}
+
+    def weight(self, partition):
+        """Returns the weight of a partition.
+
+        :param partition: The partition.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :rtype: float
+        """
+        weight = self.weights.get(partition.queue_name)
+        if weight is not None:
+            return weight
+        full = partition.batch_size + 1
+        backlog = min(partition.buffered + 1, full)
+        return 1 + (self.max_weight - 1) * float(backlog) / full
+
+    def credit(self, partition):
+        """Credit a partition for a new pass and return the number of
+        messages it may process.
+
+        :param partition: The partition.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :rtype: int
+        """
+        name = partition.name
+        deficit = self._deficit.get(name, 0) + self.weight(partition)
+        self._deficit[name] = deficit
+        return int(deficit)
+
+    def charge(self, partition, processed):
+        """Charge a partition for the messages it processed.
+
+        :param partition: The partition.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :param processed: The number of processed messages.
+        :type processed: int
+        """
+        name = partition.name
+        if not partition.buffered:
+            # an empty partition doesn't keep its credit
+            self._deficit.pop(name, None)
+        else:
+            self._deficit[name] = max(
+                self._deficit.get(name, 0) - processed, 0)
+
+    def discard(self, name):
+        """Forget the credit of a partition.
+
+        :param name: The partition name.
+        :type name: str
+        """
+        self._deficit.pop(name, None)
+
+    def clear(self):
+        """Forget the credit of all partitions."""
+        self._deficit.clear()
+
+
+def parse_weights(values):
+    """Parse a list of `queue_name:weight` strings into a mapping of queue
+    names to weights.
+
+    :param values: A list of strings or a single string.
+    :type values: list
+    :rtype: dict
+    """
+    if isinstance(values, basestring):
+        values = [values]
+    weights = {}
+    for value in values:
+        queue_name, weight = value.rsplit(':', 1)
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError('Weight for %s must be positive.' % queue_name)
+        weights[queue_name.strip()] = weight
+    return weights
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import uuid
+
+from ujson import decode
+from ujson import encode
+
+from qdo.config import STATUS_QUEUE
+
+
+def status_partition_for(partition, status_partitions):
+    """Returns the status partition tracking a partition.
+
+    :param partition: The partition number.
+    :type partition: int
+    :param status_partitions: Number of status partitions.
+    :type status_partitions: int
+    :rtype: int
+    """
+    # map partition to one in 1 to max status partitions
+    return ((partition - 1) % status_partitions) + 1
+
+
+def status_url(status_partition, msgid):
+    """Returns the relative URL of a message in the status queue.
+
+    :param status_partition: The status partition.
+    :type status_partition: int
+    :param msgid: The message id.
+    :type msgid: unicode
+    :rtype: unicode
+    """
+    return STATUS_QUEUE + '/' + unicode(status_partition) + '%3A' + msgid
+
+
+def message_timestamp(message_id):
+    """Returns the timestamp of a `uuid1` message id or `-1` for an empty
+    or invalid message id.
+
+    :param message_id: The message id.
+    :type message_id: unicode
+    :rtype: int
+    """
+    try:
+        return uuid.UUID(message_id).time
+    except (TypeError, ValueError):
+        return -1
+
+
+def merge_status(status, name, msgid, processed):
+    """Merge a status entry into a mapping of partition names to tuples of
+    the status message id and the id of the last processed message. The
+    newer of two processed message ids wins. Entries of grouped status
+    records have no status message id of their own and keep the one already
+    known for the partition.
+
+    :param status: The mapping to update.
+    :type status: dict
+    :param name: The partition name.
+    :type name: unicode
+    :param msgid: The status message id or `None`.
+    :type msgid: unicode
+    :param processed: The id of the last processed message.
+    :type processed: unicode
+    """
+    old_msgid, old_processed = status.get(name, (None, None))
+    if msgid is None:
+        msgid = old_msgid
+    if old_processed is not None and \
+       message_timestamp(old_processed) > message_timestamp(processed):
+        processed = old_processed
+    status[name] = (msgid, processed)
+
+
+class StatusRecords(object):
+    """Keeps the checkpoints of all partitions of one worker in a single
+    status record per status partition, instead of one status message per
+    partition. Writing a status record commits the checkpoints of all its
+    partitions at once.
+
+    The checkpoints of released partitions are kept in the record, as the
+    record is replaced with each write and their new owner might not have
+    written a checkpoint of its own yet. As the newest checkpoint of each
+    partition wins, outdated entries do no harm.
+
+    A status record is a status message with a body like::
+
+        {"partitions": {"<partition name>": "<message id>"},
+         "last_worker": "<worker id>"}
+
+    :param queuey_conn: A
+        :py:class:`Queuey client <queuey_py.Client>` instance.
+    :type queuey_conn: object
+    :param worker_id: An id for the current worker process.
+    :type worker_id: unicode
+    """
+
+    def __init__(self, queuey_conn, worker_id=''):
+        self.queuey_conn = queuey_conn
+        self.worker_id = worker_id
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def write(self, status_partition, values):
+        """Update the checkpoints of some partitions and write the status
+        record of their status partition.
+
+        :param status_partition: The status partition of all partitions.
+        :type status_partition: int
+        :param values: A mapping of partition names to the ids of their last
+            processed messages.
+        :type values: dict
+        """
+        with self._lock:
+            if status_partition not in self._records:
+                self._records[status_partition] = (uuid.uuid1().hex, {})
+            msgid, record = self._records[status_partition]
+            record.update(values)
+            # write while holding the lock, so no older version of the
+            # record can overwrite a newer one
+            self.queuey_conn.put(status_url(status_partition, msgid),
+                data=encode(dict(
+                    partitions=record, last_worker=self.worker_id)),
+                headers={'X-TTL': '2592000'},  # thirty days
+            )
+
+
+def status_messages(queuey_conn, status_partition, page_size=1000):
+    """Yield all messages of a status partition from oldest to newest, as
+    tuples of the message id and the decoded message body. The messages
+    are read page by page.
+
+    :param queuey_conn: A
+        :py:class:`Queuey client <queuey_py.Client>` instance.
+    :type queuey_conn: object
+    :param status_partition: The status partition.
+    :type status_partition: int
+    :param page_size: Number of messages read per request.
+    :type page_size: int
+    """
+    since = None
+    while 1:
+        # Queuey includes the `since` message, which gets filtered out
+        limit = page_size + 1 if since else page_size
+        messages = queuey_conn.messages(STATUS_QUEUE,
+            partition=status_partition, since=since, limit=limit)
+        for message in messages:
+            yield message['message_id'], decode(message['body'])
+        if len(messages) < page_size:
+            break
+        since = messages[-1]['message_id']
+
+
+def delete_status_messages(queuey_conn, keys, chunk_size=50):
+    """Delete messages from the status queue, a chunk of them per request.
+
+    :param queuey_conn: A
+        :py:class:`Queuey client <queuey_py.Client>` instance.
+    :type queuey_conn: object
+    :param keys: A list of tuples of status partition and message id.
+    :type keys: list
+    :param chunk_size: Number of messages deleted per request.
+    :type chunk_size: int
+    """
+    for i in xrange(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        queuey_conn.delete(STATUS_QUEUE + '/' + ','.join(
+            [u'%s%%3A%s' % (sp, msgid) for sp, msgid in chunk]))
+
+
+def stale_status_messages(entries, partitions, status_partitions=None):
+    """Returns the keys of all status messages, which are no longer needed.
+    These are the messages of partitions which don't exist anymore and all
+    but the newest message of each remaining partition. Status records are
+    only kept, if they hold the newest recorded checkpoint of any existing
+    partition.
+
+    If the number of status partitions is given, messages in the status
+    partition of the current layout are preferred over messages with the
+    same checkpoint in another status partition. Messages left behind by
+    earlier layouts are kept until the partition has been written using the
+    current layout.
+
+    :param entries: A list of tuples of status partition, message id and
+        decoded message body, ordered from oldest to newest within each
+        status partition.
+    :type entries: list
+    :param partitions: Names of all existing partitions.
+    :type partitions: set
+    :param status_partitions: Number of status partitions.
+    :type status_partitions: int
+    :rtype: list
+    """
+    def current(sp, name):
+        if status_partitions is None:
+            return True
+        number = int(name.split('-')[1])
+        return sp == status_partition_for(number, status_partitions)
+
+    messages = {}
+    best = {}
+    records = []
+    stale = []
+    for index, (sp, msgid, body) in enumerate(entries):
+        key = (sp, msgid)
+        if 'partitions' in body:
+            records.append(key)
+            for name, processed in body['partitions'].items():
+                if name not in partitions:
+                    continue
+                rank = (message_timestamp(processed), current(sp, name),
+                    index)
+                if name not in best or rank > best[name][0]:
+                    best[name] = (rank, key)
+            continue
+        name = body['partition']
+        if name not in partitions:
+            stale.append(key)
+            continue
+        is_current = current(sp, name)
+        rank = (message_timestamp(body['processed']), is_current, index)
+        messages.setdefault(name, []).append((rank, key, is_current))
+    for name, found in messages.items():
+        if not any(is_current for rank, key, is_current in found):
+            # the partition hasn't been written using the current layout
+            continue
+        found.sort()
+        stale.extend(key for rank, key, is_current in found[:-1])
+    needed = set(key for rank, key in best.values())
+    stale.extend(key for key in records if key not in needed)
+    return stale
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sqlite3
+import threading
+
+from kazoo.exceptions import NoNodeError
+
+
+class CheckpointStore(object):
+    """The interface of a checkpoint store, which keeps the message id of
+    the last processed message of each partition.
+    """
+
+    def load(self):
+        """Returns a mapping of partition names to a tuple of the status
+        message id and the id of the last processed message. Stores which
+        don't use status messages return `None` as the status message id.
+
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def group_key(self, partition):
+        """Returns a key, identifying the checkpoints which can be saved
+        together with a single :py:meth:`save` call.
+
+        :param partition: The partition.
+        :type partition: :py:class:`qdo.partition.Partition`
+        """
+        return partition.name
+
+    def save(self, checkpoints):
+        """Save checkpoints, all sharing the same :py:meth:`group_key`.
+
+        :param checkpoints: A list of tuples of partition and the message id
+            of its last processed message.
+        :type checkpoints: list
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release all resources held by the store."""
+
+
+class QueueyStore(CheckpointStore):
+    """Stores checkpoints in the status queue in Queuey. This is the
+    default store.
+
+    :param worker: The worker, used to load the status.
+    :type worker: :py:class:`qdo.worker.Worker`
+    """
+
+    def __init__(self, worker=None):
+        self.worker = worker
+
+    def load(self):
+        return self.worker.status_partitions()
+
+    def group_key(self, partition):
+        if partition.records is not None:
+            # all partitions of one status record
+            return partition.status_partition
+        return partition.name
+
+    def save(self, checkpoints):
+        partition, value = checkpoints[0]
+        if partition.records is None:
+            for partition, value in checkpoints:
+                partition._update_status_message(value)
+        else:
+            partition.records.write(partition.status_partition,
+                dict((p.name, v) for p, v in checkpoints))
+
+
+class ZooKeeperStore(CheckpointStore):
+    """Stores checkpoints in ZooKeeper, one node per partition.
+
+    :param zk: A connected :py:class:`kazoo.client.KazooClient` instance.
+    :type zk: object
+    :param path: The node holding all checkpoint nodes.
+    :type path: str
+    """
+
+    def __init__(self, zk, path='/checkpoints'):
+        self.zk = zk
+        self.path = path
+
+    def load(self):
+        zk = self.zk
+        try:
+            names = zk.get_children(self.path)
+        except NoNodeError:
+            return {}
+        status = {}
+        for name in names:
+            data, stat = zk.get(self.path + '/' + name)
+            status[name] = (None, data.decode('utf-8'))
+        return status
+
+    def save(self, checkpoints):
+        zk = self.zk
+        for partition, value in checkpoints:
+            node = self.path + '/' + partition.name
+            data = value.encode('utf-8')
+            try:
+                zk.set(node, data)
+            except NoNodeError:
+                zk.create(node, data, makepath=True)
+
+
+class SQLiteStore(CheckpointStore):
+    """Stores checkpoints in a local SQLite database. All pending
+    checkpoints are saved in a single transaction. Only useful if all
+    workers run on a single machine.
+
+    :param path: The path of the database file.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # the connection is shared with the checkpoint writer thread
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS checkpoints '
+                '(partition TEXT PRIMARY KEY, processed TEXT NOT NULL)')
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT partition, processed FROM checkpoints').fetchall()
+        return dict((name, (None, processed)) for name, processed in rows)
+
+    def group_key(self, partition):
+        return None
+
+    def save(self, checkpoints):
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO checkpoints '
+                    '(partition, processed) VALUES (?, ?)',
+                    [(p.name, v) for p, v in checkpoints])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
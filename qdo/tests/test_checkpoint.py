@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import unittest
+
+
+class DummyStore(object):
+
+    def __init__(self, grouped=False):
+        self.grouped = grouped
+        self.saved = []
+        self.failing = False
+
+    def group_key(self, partition):
+        return None if self.grouped else partition.name
+
+    def save(self, checkpoints):
+        if self.failing:
+            raise ValueError('save failed')
+        for partition, value in checkpoints:
+            if partition.event is not None:
+                partition.event.wait()
+            partition.values.append(value)
+        self.saved.append(sorted((p.name, v) for p, v in checkpoints))
+
+
+class DummyPartition(object):
+
+    def __init__(self, name, store=None):
+        self.name = name
+        self.store = DummyStore() if store is None else store
+        self.values = []
+        self.event = None
+
+
+class TestCheckpointWriter(unittest.TestCase):
+
+    def _make_one(self, max_pending=10):
+        from qdo.checkpoint import CheckpointWriter
+        return CheckpointWriter(max_pending=max_pending)
+
+    def test_flush(self):
+        writer = self._make_one()
+        partition = DummyPartition('a-1')
+        writer.submit(partition, '1')
+        writer.submit(partition, '2')
+        writer.flush()
+        # only the newest value is written
+        self.assertEqual(partition.values, ['2'])
+
+    def test_flush_failure(self):
+        writer = self._make_one()
+        store = DummyStore()
+        partitions = [DummyPartition('a-%s' % i, store=store)
+            for i in range(3)]
+        for i, partition in enumerate(partitions):
+            writer.submit(partition, str(i))
+        store.failing = True
+        self.assertRaises(ValueError, writer.flush)
+        self.assertEqual(store.saved, [])
+        # the unwritten checkpoints are kept, newer values win
+        writer.submit(partitions[0], '3')
+        store.failing = False
+        writer.flush()
+        self.assertEqual([p.values for p in partitions],
+            [['3'], ['1'], ['2']])
+
+    def test_background(self):
+        writer = self._make_one()
+        partitions = [DummyPartition('a-%s' % i) for i in range(5)]
+        writer.start()
+        for i, partition in enumerate(partitions):
+            writer.submit(partition, str(i))
+        writer.stop()
+        self.assertEqual([p.values for p in partitions],
+            [['0'], ['1'], ['2'], ['3'], ['4']])
+
+    def test_backpressure(self):
+        writer = self._make_one(max_pending=1)
+        first = DummyPartition('a-1')
+        second = DummyPartition('a-2')
+        writer.submit(first, '1')
+        submitted = threading.Event()
+
+        def submit():
+            writer.submit(second, '2')
+            submitted.set()
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        # the writer isn't running, so the second submit has to wait
+        self.assertFalse(submitted.wait(0.05))
+        writer.start()
+        thread.join()
+        writer.stop()
+        self.assertEqual(first.values, ['1'])
+        self.assertEqual(second.values, ['2'])
+
+    def test_backpressure_flush(self):
+        writer = self._make_one(max_pending=1)
+        first = DummyPartition('a-1')
+        second = DummyPartition('b-1')
+        writer.submit(first, '1')
+        submitted = threading.Event()
+
+        def submit():
+            writer.submit(second, '2')
+            submitted.set()
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        self.assertFalse(submitted.wait(0.05))
+        # the blocked submit continues with the new pending checkpoints
+        writer.flush()
+        thread.join()
+        writer.flush()
+        self.assertEqual(first.values, ['1'])
+        self.assertEqual(second.values, ['2'])
+
+    def test_grouped(self):
+        writer = self._make_one()
+        store = DummyStore(grouped=True)
+        for i in range(3):
+            writer.submit(DummyPartition('a-%s' % i, store=store), str(i))
+        other = DummyPartition('b-1')
+        writer.submit(other, 'b')
+        writer.flush()
+        # a single save for all partitions of the grouped store
+        self.assertEqual(store.saved, [[('a-0', '0'), ('a-1', '1'),
+            ('a-2', '2')]])
+        self.assertEqual(other.store.saved, [[('b-1', 'b')]])
@@ -21,9 +21,28 @@ class TestConfig(unittest.TestCase):
         qdo_section = settings.getsection('qdo-worker')
         self.assertEqual(qdo_section['wait_interval'], 30)
         self.assertEqual(qdo_section['name'], '')
+        self.assertEqual(qdo_section['job_batch'], None)
+        self.assertEqual(qdo_section['batch_size'], 20)
+        self.assertEqual(qdo_section['concurrency'], 1)
+        self.assertEqual(qdo_section['fetch_concurrency'], 1)
+        self.assertEqual(qdo_section['prefetch_budget'], 0)
+        self.assertEqual(qdo_section['checkpoint_every_messages'], 1)
+        self.assertEqual(qdo_section['checkpoint_every_seconds'], 0)
+        self.assertEqual(qdo_section['checkpoint_async'], False)
+        self.assertEqual(qdo_section['checkpoint_format'], 'partition')
+        self.assertEqual(qdo_section['status_partitions'], 7)
+        self.assertEqual(qdo_section['checkpoint_store'], 'queuey')
+        self.assertEqual(qdo_section['checkpoint_path'], None)
+        self.assertEqual(qdo_section['checkpoint_journal'], None)
+        self.assertEqual(qdo_section['checkpoint_journal_sync'], 0)
+        self.assertEqual(qdo_section['partition_cache_size'], 0)
+        self.assertEqual(qdo_section['status_compact_interval'], 0)
         queuey_section = settings.getsection('queuey')
         self.assertEqual(queuey_section['connection'],
             'http://127.0.0.1:5000/v1/queuey/')
+        self.assertEqual(queuey_section['metadata_ttl'], 0)
+        self.assertEqual(queuey_section['pool_size'], 0)
+        self.assertEqual(queuey_section['eject_time'], 30)
         zk_section = settings.getsection('zookeeper')
         self.assertEqual(zk_section['connection'], config.ZOO_DEFAULT_CONN)
 
@@ -49,5 +68,9 @@ class TestConfig(unittest.TestCase):
         settings = self._make_one(extra)
         p_section = settings.getsection('partitions')
         self.assertEqual(p_section['policy'], 'manual')
+        self.assertEqual(p_section['max_weight'], 1)
+        self.assertEqual(p_section['discovery_interval'], 0)
+        self.assertEqual(p_section['include'], [])
+        self.assertEqual(p_section['exclude'], [])
         self.assertEqual(
             p_section['ids'], ['a4bb2fb6dcda4b68aad743a4746d7f58-1'])
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+import unittest
+
+
+class TestJobTable(unittest.TestCase):
+
+    def _make_one(self, jobs, default=None):
+        from qdo.jobs import JobTable
+        return JobTable(jobs, default=default)
+
+    def _make_job(self, name, queues=(), job_context=None):
+        from qdo.jobs import Job
+        return Job(name, queues=queues, job_context=job_context)
+
+    def test_get(self):
+        one = self._make_job('one', queues=['abc', 'de*'])
+        two = self._make_job('two', queues=['d*'])
+        table = self._make_one([one, two])
+        self.assertTrue(table.get('abc') is one)
+        self.assertTrue(table.get('def') is one)
+        self.assertTrue(table.get('dxx') is two)
+        self.assertTrue(table.get('xyz') is None)
+
+    def test_default(self):
+        one = self._make_job('one', queues=['abc'])
+        default = self._make_job('')
+        table = self._make_one([one], default=default)
+        self.assertTrue(table.get('abc') is one)
+        self.assertTrue(table.get('xyz') is default)
+        self.assertEqual(list(table), [default, one])
+
+    def test_contexts(self):
+        events = []
+
+        def make_context(name):
+            @contextmanager
+            def job_context():
+                events.append('enter-' + name)
+                yield name
+                events.append('exit-' + name)
+            return job_context
+
+        table = self._make_one([
+            self._make_job('one', job_context=make_context('one')),
+            self._make_job('two', job_context=make_context('two')),
+        ])
+        with table.contexts() as contexts:
+            self.assertEqual(contexts, {'one': 'one', 'two': 'two'})
+        self.assertEqual(events,
+            ['enter-one', 'enter-two', 'exit-two', 'exit-one'])
+
+
+class TestCompilePatterns(unittest.TestCase):
+
+    def _call(self, patterns):
+        from qdo.jobs import compile_patterns
+        return compile_patterns(patterns)
+
+    def test_empty(self):
+        self.assertTrue(self._call([]) is None)
+
+    def test_patterns(self):
+        regex = self._call(['abc', 'def*'])
+        self.assertTrue(regex.match('abc'))
+        self.assertTrue(regex.match('def'))
+        self.assertTrue(regex.match('defabc'))
+        self.assertFalse(regex.match('abcd'))
+        self.assertFalse(regex.match('xdef'))
+
+    def test_single(self):
+        regex = self._call('abc*')
+        self.assertTrue(regex.match('abcd'))
+        self.assertFalse(regex.match('ab'))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+OLD = u'a8f70ab3cb7411e19621b88d120c81de'
+NEW = u'b8f70ab3cb7411e19621b88d120c81de'
+
+
+class TestCheckpointJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tempdir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _make_one(self, name='worker', **kwargs):
+        from qdo.journal import CheckpointJournal
+        return CheckpointJournal(self.directory, name, **kwargs)
+
+    def test_load_empty(self):
+        self.assertEqual(self._make_one().load(), {})
+
+    def test_record(self):
+        journal = self._make_one()
+        journal.open()
+        journal.record(u'a-1', OLD)
+        journal.record(u'a-2', OLD)
+        journal.record(u'a-1', NEW)
+        # synced on every record
+        self.assertEqual(self._make_one().load(), {u'a-1': NEW, u'a-2': OLD})
+        journal.close()
+
+    def test_incomplete_line(self):
+        journal = self._make_one()
+        journal.open()
+        journal.record(u'a-1', OLD)
+        journal.close()
+        with open(journal.path, 'ab') as f:
+            f.write('a-1 b8f70ab3')
+        self.assertEqual(journal.load(), {u'a-1': OLD})
+
+    def test_newest_wins(self):
+        first = self._make_one('first')
+        first.open()
+        first.record(u'a-1', NEW)
+        first.record(u'a-2', OLD)
+        first.close()
+        second = self._make_one('second')
+        second.open()
+        second.record(u'a-1', OLD)
+        second.record(u'a-2', NEW)
+        second.close()
+        self.assertEqual(second.load(), {u'a-1': NEW, u'a-2': NEW})
+
+    def test_rotate(self):
+        journal = self._make_one(max_size=200)
+        journal.open()
+        for i in range(10):
+            journal.record(u'a-1', OLD)
+            journal.record(u'a-2', NEW)
+        self.assertTrue(os.path.getsize(journal.path) <= 200)
+        journal.close()
+        self.assertEqual(journal.load(), {u'a-1': OLD, u'a-2': NEW})
+        # reopening keeps the latest checkpoints for the next rotation
+        journal.open()
+        for i in range(5):
+            journal.record(u'a-3', OLD)
+        journal.close()
+        self.assertEqual(journal.load(),
+            {u'a-1': OLD, u'a-2': NEW, u'a-3': OLD})
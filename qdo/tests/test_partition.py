@@ -11,12 +11,12 @@ class TestPartition(BaseTestCase):
 
     dummy_uuid = 'a8f70ab3cb7411e19621b88d120c81de'
 
-    def _make_one(self):
+    def _make_one(self, **kwargs):
         from qdo.partition import Partition
         self.conn = self._make_queuey_conn()
         self.queue_name = self.conn.create_queue()
         self.conn.create_queue(queue_name=STATUS_QUEUE)
-        self.partition = Partition(self.conn, self.queue_name)
+        self.partition = Partition(self.conn, self.queue_name, **kwargs)
         return self.partition
 
     def test_name(self):
@@ -32,10 +32,78 @@ class TestPartition(BaseTestCase):
         bodies = [m['body'] for m in messages]
         self.assertTrue('Hello world!' in bodies)
 
+    def test_next_message(self):
+        partition = self._make_one(batch_size=2)
+        self.conn.post(url=self.queue_name, data=['1', '2', '3'])
+        bodies = []
+        message = partition.next_message()
+        while message is not None:
+            bodies.append(message['body'])
+            partition.last_message = message['message_id']
+            message = partition.next_message()
+        self.assertEqual(bodies, ['1', '2', '3'])
+
+    def test_fetch(self):
+        partition = self._make_one(batch_size=2)
+        self.conn.post(url=self.queue_name, data=['1', '2', '3', '4'])
+        self.assertEqual(partition.fetch(), 2)
+        # no new fetch, while there are buffered messages
+        self.assertEqual(partition.fetch(), 2)
+        self.assertEqual(partition.next_message(fetch=False)['body'], '1')
+
+    def test_fetch_low_water(self):
+        partition = self._make_one(batch_size=2)
+        self.conn.post(url=self.queue_name, data=['1', '2', '3', '4', '5'])
+        self.assertEqual(partition.fetch(), 2)
+        partition.next_message(fetch=False)
+        # the next batch continues after the last buffered message
+        self.assertEqual(partition.fetch(low_water=1), 3)
+        bodies = [partition.next_message(fetch=False)['body']
+            for i in range(3)]
+        self.assertEqual(bodies, ['2', '3', '4'])
+
+    def test_next_messages(self):
+        partition = self._make_one(batch_size=3)
+        self.conn.post(url=self.queue_name, data=['1', '2', '3', '4'])
+        self.assertEqual(partition.next_messages(2), [])
+        partition.fetch()
+        bodies = [m['body'] for m in partition.next_messages(2)]
+        self.assertEqual(bodies, ['1', '2'])
+        self.assertEqual(partition.buffered, 1)
+
+    def test_backoff(self):
+        partition = self._make_one(wait_interval=10)
+        self.assertTrue(partition.due())
+        self.assertEqual(partition.fetch(), 0)
+        self.assertEqual(partition.idle, 1)
+        self.assertFalse(partition.due())
+        self.assertTrue(partition.due(now=partition.next_poll))
+        self.conn.post(url=self.queue_name, data='Hello world!')
+        self.assertEqual(partition.fetch(), 1)
+        self.assertEqual(partition.idle, 0)
+        self.assertTrue(partition.due())
+
+    def test_next_message_empty(self):
+        partition = self._make_one()
+        self.assertTrue(partition.next_message() is None)
+
     def test_last_message_get(self):
         partition = self._make_one()
         self.assertEqual(partition.last_message, '')
 
+    def test_last_message_new(self):
+        partition = self._make_one()
+        # the status message is only created by the first checkpoint
+        self.assertEqual(partition._get_status_message(), None)
+        partition.last_message = self.dummy_uuid
+        self.assertEqual(partition._get_status_message()['processed'],
+            self.dummy_uuid)
+
+    def test_last_message_known(self):
+        partition = self._make_one(msgid=self.dummy_uuid,
+            last_message=self.dummy_uuid)
+        self.assertEqual(partition.last_message, self.dummy_uuid)
+
     def test_last_message_set(self):
         partition = self._make_one()
         partition.last_message = self.dummy_uuid
@@ -45,3 +113,20 @@ class TestPartition(BaseTestCase):
         partition = self._make_one()
         partition.last_message = self.dummy_uuid.encode('utf-8')
         self.assertEqual(partition.last_message, self.dummy_uuid)
+
+    def test_last_message_coalesced(self):
+        partition = self._make_one(checkpoint_every_messages=2)
+        partition.last_message = self.dummy_uuid
+        self.assertEqual(partition.last_message, self.dummy_uuid)
+        self.assertEqual(partition._get_status_message(), None)
+        partition.last_message = self.dummy_uuid
+        self.assertEqual(partition._get_status_message()['processed'],
+            self.dummy_uuid)
+
+    def test_flush(self):
+        partition = self._make_one(checkpoint_every_messages=0)
+        partition.last_message = self.dummy_uuid
+        self.assertEqual(partition._get_status_message(), None)
+        partition.flush()
+        self.assertEqual(partition._get_status_message()['processed'],
+            self.dummy_uuid)
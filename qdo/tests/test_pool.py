@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+import threading
+import unittest
+
+
+class TestJobPool(unittest.TestCase):
+
+    def _make_one(self, size=2):
+        from qdo.pool import JobPool
+        self.contexts = contexts = []
+
+        @contextmanager
+        def job_context():
+            context = dict(done=False)
+            contexts.append(context)
+            yield context
+            context['done'] = True
+
+        pool = JobPool(size, job_context)
+        pool.start()
+        return pool
+
+    def test_contexts(self):
+        pool = self._make_one(size=3)
+        pool.stop()
+        self.assertEqual(len(self.contexts), 3)
+        self.assertTrue(all(c['done'] for c in self.contexts))
+
+    def test_submit(self):
+        pool = self._make_one()
+        event = threading.Event()
+        results = []
+
+        def task(context):
+            event.wait()
+            results.append(1)
+
+        pool.submit('a-1', task)
+        self.assertTrue(pool.busy('a-1'))
+        self.assertFalse(pool.busy('a-2'))
+        self.assertEqual(pool.active, 1)
+        event.set()
+        pool.join()
+        self.assertFalse(pool.busy('a-1'))
+        self.assertEqual(results, [1])
+        pool.stop()
+
+    def test_error(self):
+        pool = self._make_one()
+
+        def task(context):
+            raise ValueError('task failed')
+
+        pool.submit('a-1', task)
+        self.assertRaises(ValueError, pool.join)
+        pool.stop()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+import ujson
+
+
+class DummyResponse(object):
+
+    def __init__(self, text):
+        self.text = text
+
+
+class DummyConnection(object):
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.requests = 0
+
+    def get(self, url='', params=None):
+        self.requests += 1
+        return DummyResponse(ujson.encode({'status': 'ok', 'queues': [
+            {'queue_name': name, 'partitions': count}
+            for name, count in self.queues]}))
+
+
+class TestQueueCache(unittest.TestCase):
+
+    def _make_one(self, queues, ttl=0):
+        from qdo.queues import QueueCache
+        self.conn = DummyConnection(queues)
+        return QueueCache(self.conn, ttl=ttl)
+
+    def test_partitions(self):
+        cache = self._make_one([('b', 2), ('a', 1)])
+        self.assertEqual(cache.partitions(), ['b-1', 'b-2', 'a-1'])
+        self.assertEqual(cache.queues(), [('b', 2), ('a', 1)])
+        # without a ttl, the queues are listed every time
+        self.assertEqual(self.conn.requests, 2)
+
+    def test_ttl(self):
+        cache = self._make_one([('a', 1)], ttl=60)
+        cache.partitions()
+        self.conn.queues.append(('b', 1))
+        self.assertEqual(cache.partitions(), ['a-1'])
+        self.assertEqual(self.conn.requests, 1)
+        self.assertEqual(cache.partitions(refresh=True), ['a-1', 'b-1'])
+        cache.invalidate()
+        cache.partitions()
+        self.assertEqual(self.conn.requests, 3)
+
+    def test_update(self):
+        cache = self._make_one([('a', 1)], ttl=60)
+        # nothing is recorded before the first listing
+        cache.update('b', 1)
+        self.assertEqual(cache.queues(), [('a', 1)])
+        cache.update('a', 3)
+        cache.update('c', 1)
+        self.assertEqual(cache.partitions(), ['a-1', 'a-2', 'a-3', 'c-1'])
+        self.assertEqual(self.conn.requests, 1)
@@ -5,7 +5,9 @@
 
 from cStringIO import StringIO
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 HERE = os.path.dirname(__file__)
@@ -44,6 +46,59 @@ class TestArgsParser(unittest.TestCase):
         namespace = parse_args(['-c', TEST_CONFIG])
         self.assertEqual(namespace.configfile, TEST_CONFIG)
 
+    def test_parse_args_processes(self):
+        from qdo.runner import parse_args
+        namespace = parse_args(['-p', '3'])
+        self.assertEqual(namespace.processes, 3)
+
+    def test_parse_args_compact_status(self):
+        from qdo.runner import parse_args
+        self.assertFalse(parse_args([]).compact_status)
+        namespace = parse_args(['--compact-status'])
+        self.assertTrue(namespace.compact_status)
+
+
+class DummyWorker(object):
+
+    def __init__(self, settings):
+        self.name = settings['qdo-worker.name']
+        self.path = settings['test.path']
+
+    def work(self):
+        marker = os.path.join(self.path, 'crashed-' + self.name)
+        if self.name.endswith('-0') and not os.path.exists(marker):
+            # crash the first process once
+            open(marker, 'w').close()
+            raise ValueError('crashed')
+        open(os.path.join(self.path, self.name), 'w').close()
+
+    def stop(self):
+        pass
+
+
+class TestProcesses(unittest.TestCase):
+
+    def setUp(self):
+        from qdo import worker
+        self.path = tempfile.mkdtemp()
+        self.old_worker = worker.Worker
+        worker.Worker = DummyWorker
+
+    def tearDown(self):
+        from qdo import worker
+        worker.Worker = self.old_worker
+        shutil.rmtree(self.path)
+
+    def test_run_processes(self):
+        from qdo.config import QdoSettings
+        from qdo.runner import run_processes
+        settings = QdoSettings()
+        settings['qdo-worker.name'] = 'test'
+        settings['test.path'] = self.path
+        run_processes(settings, 3)
+        self.assertEqual(sorted(os.listdir(self.path)),
+            ['crashed-test-0', 'test-0', 'test-1', 'test-2'])
+
 
 class TestRunner(unittest.TestCase):
 
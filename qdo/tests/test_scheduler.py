@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+
+class DummyPartition(object):
+
+    def __init__(self, queue_name, buffered=0, batch_size=9):
+        self.queue_name = queue_name
+        self.name = queue_name + '-1'
+        self.buffered = buffered
+        self.batch_size = batch_size
+
+
+class TestDeficitScheduler(unittest.TestCase):
+
+    def _make_one(self, **kwargs):
+        from qdo.scheduler import DeficitScheduler
+        return DeficitScheduler(**kwargs)
+
+    def test_default(self):
+        scheduler = self._make_one()
+        partition = DummyPartition('a', buffered=9)
+        self.assertEqual(scheduler.credit(partition), 1)
+        scheduler.charge(partition, 1)
+        self.assertEqual(scheduler.credit(partition), 1)
+
+    def test_backlog(self):
+        scheduler = self._make_one(max_weight=5)
+        busy = DummyPartition('a', buffered=9)
+        idle = DummyPartition('b', buffered=0)
+        self.assertEqual(scheduler.credit(busy), 5)
+        self.assertEqual(scheduler.credit(idle), 1)
+
+    def test_configured_weight(self):
+        scheduler = self._make_one(weights={'a': 0.5})
+        partition = DummyPartition('a', buffered=5)
+        self.assertEqual(scheduler.credit(partition), 0)
+        # the credit is saved up for the next pass
+        self.assertEqual(scheduler.credit(partition), 1)
+        scheduler.charge(partition, 1)
+        self.assertEqual(scheduler.credit(partition), 0)
+
+    def test_charge_empty(self):
+        scheduler = self._make_one(weights={'a': 2.5})
+        partition = DummyPartition('a', buffered=5)
+        self.assertEqual(scheduler.credit(partition), 2)
+        partition.buffered = 0
+        scheduler.charge(partition, 2)
+        # an empty partition loses its remaining credit
+        self.assertEqual(scheduler.credit(partition), 2)
+
+    def test_discard(self):
+        scheduler = self._make_one(weights={'a': 1.5})
+        partition = DummyPartition('a', buffered=5)
+        self.assertEqual(scheduler.credit(partition), 1)
+        scheduler.discard(partition.name)
+        scheduler.discard(partition.name)
+        self.assertEqual(scheduler.credit(partition), 1)
+
+    def test_parse_weights(self):
+        from qdo.scheduler import parse_weights
+        self.assertEqual(parse_weights(['a:2', 'b: 0.5']),
+            {'a': 2.0, 'b': 0.5})
+        self.assertEqual(parse_weights('a:3'), {'a': 3.0})
+        self.assertRaises(ValueError, parse_weights, ['a:0'])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+import ujson
+
+OLD = u'a8f70ab3cb7411e19621b88d120c81de'
+NEW = u'b8f70ab3cb7411e19621b88d120c81de'
+
+
+def _entry(sp, msgid, name, processed=u''):
+    return (sp, msgid, dict(partition=name, processed=processed))
+
+
+def _record(sp, msgid, **partitions):
+    return (sp, msgid, dict(partitions=partitions))
+
+
+class TestMergeStatus(unittest.TestCase):
+
+    def _call(self, *entries):
+        from qdo.status import merge_status
+        status = {}
+        for entry in entries:
+            merge_status(status, *entry)
+        return status
+
+    def test_newest_processed(self):
+        self.assertEqual(self._call(('a-1', 'm1', NEW), ('a-1', 'm2', OLD)),
+            {'a-1': ('m2', NEW)})
+
+    def test_record(self):
+        self.assertEqual(self._call(('a-1', 'm1', OLD), ('a-1', None, NEW)),
+            {'a-1': ('m1', NEW)})
+        self.assertEqual(self._call(('a-1', None, u''), ('a-1', None, OLD)),
+            {'a-1': (None, OLD)})
+
+
+class DummyConnection(object):
+
+    def __init__(self):
+        self.messages = {}
+
+    def put(self, url, data='', headers=None):
+        self.messages[url] = ujson.decode(data)
+
+
+class TestStatusRecords(unittest.TestCase):
+
+    def _make_one(self, conn, worker_id):
+        from qdo.status import StatusRecords
+        return StatusRecords(conn, worker_id=worker_id)
+
+    def _status(self, conn):
+        from qdo.status import merge_status
+        status = {}
+        for body in conn.messages.values():
+            for name, processed in body['partitions'].items():
+                merge_status(status, name, None, processed)
+        return dict((name, v[1]) for name, v in status.items())
+
+    def test_release(self):
+        conn = DummyConnection()
+        first = self._make_one(conn, u'first')
+        first.write(1, {'a-1': OLD, 'a-8': OLD})
+        # both partitions are released and acquired by another worker,
+        # which only writes a checkpoint for a-1
+        second = self._make_one(conn, u'second')
+        second.write(1, {'a-1': NEW})
+        # the first worker rewrites its record for another partition
+        first.write(1, {'a-15': OLD})
+        self.assertEqual(len(conn.messages), 2)
+        self.assertEqual(self._status(conn),
+            {'a-1': NEW, 'a-8': OLD, 'a-15': OLD})
+
+
+class TestStaleStatusMessages(unittest.TestCase):
+
+    def _call(self, entries, partitions, **kwargs):
+        from qdo.status import stale_status_messages
+        return stale_status_messages(entries, set(partitions), **kwargs)
+
+    def test_empty(self):
+        self.assertEqual(self._call([], ['a-1']), [])
+
+    def test_removed_partition(self):
+        entries = [_entry(1, 'm1', 'a-1'), _entry(2, 'm2', 'b-2')]
+        self.assertEqual(self._call(entries, ['a-1']), [(2, 'm2')])
+
+    def test_duplicates(self):
+        entries = [_entry(1, 'm1', 'a-1'), _entry(1, 'm2', 'b-1'),
+            _entry(1, 'm3', 'a-1'), _entry(1, 'm4', 'a-1')]
+        self.assertEqual(self._call(entries, ['a-1', 'b-1']),
+            [(1, 'm1'), (1, 'm3')])
+
+    def test_records(self):
+        entries = [_record(1, 'r1', **{'a-1': NEW, 'b-1': OLD}),
+            _record(1, 'r2', **{'a-1': OLD, 'b-1': NEW}),
+            _record(1, 'r3', **{'a-1': OLD, 'c-1': NEW}),
+            _record(1, 'r4')]
+        self.assertEqual(self._call(entries, ['a-1', 'b-1']),
+            [(1, 'r3'), (1, 'r4')])
+
+    def test_layout(self):
+        entries = [_entry(1, 'm1', 'a-8'), _entry(8, 'm1', 'a-8'),
+            _entry(1, 'm2', 'b-8'), _entry(3, 'm3', 'a-3')]
+        self.assertEqual(
+            self._call(entries, ['a-3', 'a-8', 'b-8'], status_partitions=11),
+            [(1, 'm1')])
+        # the old layout is kept until the partition is written again
+        entries = [_entry(1, 'm1', 'a-8'), _entry(1, 'm2', 'a-8')]
+        self.assertEqual(self._call(entries, ['a-8'], status_partitions=11),
+            [])
+
+    def test_layout_changes(self):
+        # a-8 was written using 5, then 7 status partitions
+        entries = [_entry(3, 'm1', 'a-8', NEW), _entry(1, 'm2', 'a-8', OLD)]
+        # both are kept while 11 status partitions are used
+        self.assertEqual(self._call(entries, ['a-8'], status_partitions=11),
+            [])
+        # the newest checkpoint wins, in the current layout if it's a tie
+        entries.append(_entry(8, 'm3', 'a-8', NEW))
+        self.assertEqual(sorted(
+            self._call(entries, ['a-8'], status_partitions=11)),
+            [(1, 'm2'), (3, 'm1')])
+        entries[-1] = _entry(8, 'm3', 'a-8', OLD)
+        self.assertEqual(sorted(
+            self._call(entries, ['a-8'], status_partitions=11)),
+            [(1, 'm2'), (8, 'm3')])
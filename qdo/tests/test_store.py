@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class DummyPartition(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class TestSQLiteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'checkpoints.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _make_one(self):
+        from qdo.store import SQLiteStore
+        return SQLiteStore(self.path)
+
+    def test_load_empty(self):
+        store = self._make_one()
+        self.assertEqual(store.load(), {})
+        store.close()
+
+    def test_save(self):
+        store = self._make_one()
+        first = DummyPartition('a-1')
+        second = DummyPartition('a-2')
+        store.save([(first, u'1'), (second, u'2')])
+        store.save([(first, u'3')])
+        store.close()
+        store = self._make_one()
+        self.assertEqual(store.load(),
+            {'a-1': (None, u'3'), 'a-2': (None, u'2')})
+        store.close()
+
+    def test_group_key(self):
+        store = self._make_one()
+        self.assertEqual(store.group_key(DummyPartition('a-1')),
+            store.group_key(DummyPartition('b-1')))
+        store.close()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+
+import ujson
+
+from qdo import log
+
+
+class TestPooledClient(unittest.TestCase):
+
+    url = u'http://127.0.0.1:5000/v1/queuey/'
+
+    def _make_one(self, **kwargs):
+        from qdo.transport import PooledClient
+        return PooledClient(u'app_key', connection=self.url, **kwargs)
+
+    def test_session(self):
+        client = self._make_one(pool_size=4)
+        config = client.session.config
+        self.assertEqual(config['pool_maxsize'], 4)
+        self.assertEqual(config['pool_connections'], 1)
+        self.assertTrue(config['keep_alive'])
+        self.assertEqual(client.session.headers,
+            {u'Authorization': u'Application app_key'})
+
+    def test_pool_stats(self):
+        client = self._make_one()
+        self.assertEqual(client.pool_stats(), {})
+        pool = client.session.poolmanager.connection_from_url(self.url)
+        pool.num_connections = 1
+        pool.num_requests = 3
+        self.assertEqual(client.pool_stats(), {'127.0.0.1:5000': (1, 3)})
+
+    def test_report(self):
+        log.configure(None, debug=True)
+        sender = log.get_logger().sender
+        sender.msgs.clear()
+        client = self._make_one(report_interval=60)
+        pool = client.session.poolmanager.connection_from_url(self.url)
+        pool.num_connections = 2
+        pool.num_requests = 5
+        client.report()
+        pool.num_requests = 7
+        # the report interval hasn't passed yet
+        client.report()
+        client.report(force=True)
+        messages = [ujson.decode(m) for m in sender.msgs]
+        self.assertEqual(
+            [(m['fields']['name'], m['payload']) for m in messages],
+            [('queuey.connections', '2'), ('queuey.requests', '5'),
+             ('queuey.requests', '2')])
+
+
+class DummyResponse(object):
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+
+class DummySession(object):
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.requests = []
+
+    def _request(self, method, url):
+        from requests.exceptions import ConnectionError
+        self.requests.append((method, url))
+        for prefix in self.failing:
+            if url.startswith(prefix):
+                raise ConnectionError(url)
+        return DummyResponse()
+
+    def get(self, url, **kwargs):
+        return self._request('get', url)
+
+    def put(self, url, **kwargs):
+        return self._request('put', url)
+
+
+class TestNode(unittest.TestCase):
+
+    def test_record(self):
+        from qdo.transport import Node
+        node = Node(u'http://127.0.0.1:5000/', alpha=0.5)
+        node.record(latency=1.0)
+        self.assertEqual(node.latency, 1.0)
+        node.record(latency=2.0)
+        self.assertEqual(node.latency, 1.5)
+        node.record(error=True)
+        self.assertEqual(node.latency, 1.5)
+        self.assertEqual(node.error_rate, 0.5)
+        self.assertTrue(node.healthy(0))
+
+
+class TestNodeSelection(unittest.TestCase):
+
+    local = u'http://127.0.0.1:5000/v1/queuey/'
+    remote = u'http://10.0.0.1:5000/v1/queuey/'
+
+    def setUp(self):
+        log.configure(None, debug=True)
+
+    def _make_one(self, failing=(), **kwargs):
+        from qdo.transport import PooledClient
+        client = PooledClient(u'app_key',
+            connection=self.local + ',' + self.remote, **kwargs)
+        client.session = DummySession(failing=failing)
+        return client
+
+    def _node(self, client, url):
+        return [n for n in client.nodes if n.url == url][0]
+
+    def test_fastest_read(self):
+        client = self._make_one()
+        self._node(client, self.local).latency = 0.2
+        self._node(client, self.remote).latency = 0.1
+        client.get(u'queue')
+        client.put(u'queue')
+        self.assertEqual(client.session.requests, [
+            ('get', self.remote + u'queue'), ('put', self.local + u'queue')])
+
+    def test_probe(self):
+        client = self._make_one(probe_interval=60)
+        self._node(client, self.local).latency = 0.1
+        self._node(client, self.remote).latency = 0.2
+        client.get(u'queue')
+        client.get(u'queue')
+        # the slower server is probed once
+        client.get(u'queue')
+        self.assertEqual([url for method, url in client.session.requests],
+            [self.local + u'queue', self.remote + u'queue',
+             self.local + u'queue'])
+
+    def test_eject(self):
+        client = self._make_one(failing=(self.local, ), eject_time=60)
+        for i in range(3):
+            self.assertEqual(client.get(u'queue').status_code, 200)
+        node = self._node(client, self.local)
+        self.assertFalse(node.healthy(time.time()))
+        self.assertEqual([url for method, url in client.session.requests],
+            [self.local + u'queue', self.remote + u'queue',
+             self.local + u'queue', self.remote + u'queue',
+             self.remote + u'queue'])
+        # writes avoid the ejected server, until it is re-admitted
+        client.put(u'queue')
+        self.assertEqual(client.session.requests[-1][1],
+            self.remote + u'queue')
+        node.ejected_until = 0
+        client.session.failing = ()
+        client.put(u'queue')
+        self.assertEqual(client.session.requests[-1][1],
+            self.local + u'queue')
+
+    def test_all_failing(self):
+        from requests.exceptions import ConnectionError
+        client = self._make_one(failing=(self.local, self.remote))
+        self.assertRaises(ConnectionError, client.get, u'queue')
+        self.assertEqual(len(client.session.requests), 2)
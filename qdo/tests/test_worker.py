@@ -4,12 +4,18 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from contextlib import contextmanager
+import os
+import shutil
+import tempfile
 import threading
 import time
+import unittest
 
 import ujson
 from kazoo.testing import KazooTestHarness
+from requests.exceptions import ConnectionError
 
+from qdo import log
 from qdo.config import ERROR_QUEUE
 from qdo.config import QdoSettings
 from qdo.config import STATUS_PARTITIONS
@@ -32,6 +38,115 @@ def _make_worker(app_key, extra=None, queue=True):
     return worker, queue_name
 
 
+class DummyStore(object):
+
+    def __init__(self):
+        self.saved = []
+
+    def save(self, checkpoints):
+        self.saved.extend((p.name, v) for p, v in checkpoints)
+
+
+class DummyWorker(object):
+
+    queuey_conn = None
+    name = 'worker'
+    batch_size = 2
+    checkpoint_every_messages = 0
+    checkpoint_every_seconds = 0
+    checkpoint_writer = None
+    wait_interval = 0
+    status_records = None
+    status_partition_count = STATUS_PARTITIONS
+    journal = None
+
+    def __init__(self):
+        self.status = {}
+        self.store = DummyStore()
+
+
+class TestJobSections(unittest.TestCase):
+
+    def test_job_sections(self):
+        from qdo.worker import job_sections
+        settings = QdoSettings()
+        settings['jobs.example.queues'] = ['a4bb2fb6']
+        settings['jobs.example.job'] = 'qdo.testing:example_job'
+        # the defaults aren't mistaken for job sections
+        self.assertEqual(job_sections(settings), {'example': {
+            'queues': ['a4bb2fb6'], 'job': 'qdo.testing:example_job'}})
+
+
+class TestPartitionCache(unittest.TestCase):
+
+    def _make_one(self, max_size=0):
+        from qdo.worker import PartitionCache
+        self.worker = DummyWorker()
+        return PartitionCache(self.worker, max_size=max_size)
+
+    def test_evict(self):
+        cache = self._make_one()
+        partition = cache['a-1']
+        partition.last_message = u'1'
+        cache.evict('a-1')
+        self.assertFalse('a-1' in cache)
+        # the checkpoint is flushed and used for the new partition
+        self.assertEqual(self.worker.store.saved, [('a-1', u'1')])
+        self.assertEqual(cache['a-1'].last_message, u'1')
+        self.assertEqual(cache['a-1'].msgid, partition.msgid)
+
+    def test_evict_backoff(self):
+        cache = self._make_one()
+        partition = cache['a-1']
+        partition.idle = 3
+        partition.next_poll = time.time() + 100
+        cache.evict('a-1')
+        self.assertFalse(cache.due('a-1'))
+        self.assertEqual(cache.next_poll('a-1'), partition.next_poll)
+        self.assertFalse('a-1' in cache)
+        self.assertEqual(cache['a-1'].idle, 3)
+        self.assertTrue(cache.due('a-2'))
+
+    def test_discard(self):
+        cache = self._make_one()
+        partition = cache['a-1']
+        partition.last_message = u'1'
+        partition.idle = 3
+        cache.evict('a-1')
+        cache.discard('a-1')
+        self.assertTrue(cache.due('a-1'))
+        cache['a-2'].last_message = u'2'
+        cache.discard('a-2')
+        self.assertFalse('a-2' in cache)
+        self.assertEqual(self.worker.store.saved,
+            [('a-1', u'1'), ('a-2', u'2')])
+
+    def test_trim(self):
+        log.configure(None, debug=True)
+        sender = log.get_logger().sender
+        sender.msgs.clear()
+        cache = self._make_one(max_size=3)
+        cache['a-1']._buffer.append({'message_id': u'1'})
+        for i, name in enumerate(['a-2', 'a-3', 'a-4']):
+            cache[name].last_active = 3 - i
+        # the least recently active partition is busy
+        cache.trim(busy=lambda name: name == 'a-4')
+        self.assertEqual(sorted(cache.keys()), ['a-1', 'a-2', 'a-4'])
+        cache.trim()
+        self.assertEqual(sorted(cache.keys()), ['a-1', 'a-2', 'a-4'])
+        cache['a-5']
+        # all partitions are busy
+        cache.trim(busy=lambda name: True)
+        self.assertEqual(sorted(cache.keys()), ['a-1', 'a-2', 'a-4', 'a-5'])
+        cache.trim()
+        self.assertEqual(sorted(cache.keys()), ['a-1', 'a-2', 'a-4'])
+        # only trims which evicted a partition are counted
+        messages = [ujson.decode(m) for m in sender.msgs]
+        self.assertEqual([m['payload'] for m in messages
+            if m['fields']['name'] == 'worker.partition_evicted'],
+            ['1', '1'])
+
+
 class TestWorker(BaseTestCase):
 
     def _make_one(self, extra=None):
@@ -52,6 +167,190 @@ class TestWorker(BaseTestCase):
         worker.configure_partitions()
         self.assertEqual(list(worker.partitioner), [queue_name + '-2'])
 
+    def test_discover_partitions(self):
+        worker, queue_name = self._make_one()
+        worker.configure_partitions()
+        self.assertEqual(worker.discovery_interval, 0)
+        self.assertFalse(worker.discover_partitions())
+        queuey_conn = worker.queuey_conn
+        new_queue = queuey_conn.create_queue(partitions=2)
+        self.assertTrue(worker.discover_partitions())
+        self.assertEqual(list(worker.partitioner), [queue_name + '-1',
+            new_queue + '-1', new_queue + '-2'])
+        worker.partition_cache[queue_name + '-1']
+        queuey_conn.delete(queue_name)
+        self.assertTrue(worker.discover_partitions())
+        self.assertEqual(list(worker.partitioner),
+            [new_queue + '-1', new_queue + '-2'])
+        self.assertFalse(queue_name + '-1' in worker.partition_cache)
+
+    def test_discover_partitions_listing_error(self):
+        worker, queue_name = self._make_one()
+        worker.configure_partitions()
+
+        def all_partitions():
+            raise ConnectionError('listing failed')
+
+        worker.all_partitions = all_partitions
+        # the known partitions are kept
+        self.assertFalse(worker.discover_partitions())
+        self.assertEqual(list(worker.partitioner), [queue_name + '-1'])
+
+    def test_pool_size(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.concurrency': 3,
+            'qdo-worker.checkpoint_async': True,
+        })
+        self.assertEqual(worker.queuey_conn.pool_size, 5)
+        worker, queue_name = self._make_one(extra={'queuey.pool_size': 2})
+        self.assertEqual(worker.queuey_conn.pool_size, 2)
+
+    def test_filter_partitions(self):
+        worker, queue_name = self._make_one(extra={
+            'partitions.include': ['a*', 'b*'],
+            'partitions.exclude': ['ab*'],
+        })
+        self.assertEqual(
+            worker.filter_partitions(['a1-1', 'ab-1', 'b-1', 'b-2', 'c-1']),
+            ['a1-1', 'b-1', 'b-2'])
+
+    def test_status_partitions(self):
+        worker, queue_name = self._make_one()
+        worker.configure_partitions()
+        partition = worker.partition_cache[queue_name + '-1']
+        partition.last_message = 'a8f70ab3cb7411e19621b88d120c81de'
+        status = worker.status_partitions()
+        self.assertEqual(status[queue_name + '-1'],
+            (partition.msgid, 'a8f70ab3cb7411e19621b88d120c81de'))
+
+    def test_status_partitions_paging(self):
+        worker, queue_name = self._make_one()
+        queue2 = worker.queuey_conn.create_queue(partitions=STATUS_PARTITIONS)
+        worker.configure_partitions()
+        names = [queue2 + '-%s' % (i + 1) for i in range(STATUS_PARTITIONS)]
+        names += [queue_name + '-1', queue_name + '-2', queue_name + '-3']
+        for name in names:
+            partition = worker.partition_cache[name]
+            partition.last_message = 'a8f70ab3cb7411e19621b88d120c81de'
+        status = worker.status_partitions(page_size=1)
+        self.assertEqual(sorted(status.keys()), sorted(names))
+        worker.fetch_concurrency = 3
+        self.assertEqual(worker.status_partitions(page_size=2), status)
+
+    def test_compact_status(self):
+        worker, queue_name = self._make_one()
+        queue2 = worker.queuey_conn.create_queue()
+        worker.configure_partitions()
+        worker.partition_cache[queue_name + '-1'].last_message = u'a'
+        worker.partition_cache[queue2 + '-1'].last_message = u'b'
+        worker.partition_cache.clear()
+        # a duplicate status message for the same partition
+        partition = worker.partition_cache[queue_name + '-1']
+        partition.last_message = u'c'
+        worker.queuey_conn.delete(queue2)
+        self.assertEqual(worker.compact_status(page_size=1), 2)
+        self.assertEqual(worker.status_partitions(), {
+            queue_name + '-1': (partition.msgid, u'c')})
+        self.assertEqual(worker.compact_status(), 0)
+
+    def test_status_records(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.checkpoint_format': 'grouped',
+        })
+        worker.configure_partitions()
+        # an existing status message of a single partition
+        legacy = worker.partition_cache[queue_name + '-1']
+        legacy.records = None
+        legacy.msgid = u'a8f70ab3cb7411e19621b88d120c81de'
+        legacy.last_message = u'a8f70ab3cb7411e19621b88d120c81de'
+        worker.partition_cache.clear()
+        names = [queue_name + '-%s' % i for i in (1, 8, 2)]
+        for name in names:
+            partition = worker.partition_cache[name]
+            self.assertEqual(partition.last_message, u'')
+            partition.last_message = u'b8f70ab3cb7411e19621b88d120c81de'
+        status = worker.status_partitions()
+        self.assertEqual(status[names[0]],
+            (legacy.msgid, u'b8f70ab3cb7411e19621b88d120c81de'))
+        self.assertEqual(status[names[1]],
+            (None, u'b8f70ab3cb7411e19621b88d120c81de'))
+        # queue-1 and queue-8 share a status record
+        messages = worker.queuey_conn.messages(STATUS_QUEUE, partition=1)
+        self.assertEqual(len(messages), 2)
+
+    def test_status_partitions_migration(self):
+        worker, _ = self._make_one()
+        queue_name = worker.queuey_conn.create_queue(partitions=8)
+        worker.configure_partitions()
+        name = queue_name + '-8'
+        partition = worker.partition_cache[name]
+        partition.last_message = u'a8f70ab3cb7411e19621b88d120c81de'
+        worker, _ = self._make_one(extra={
+            'qdo-worker.status_partitions': 11,
+        })
+        worker.configure_partitions()
+        self.assertEqual(worker.status_queue_size, 11)
+        self.assertEqual(worker.status[name],
+            (partition.msgid, u'a8f70ab3cb7411e19621b88d120c81de'))
+        migrated = worker.partition_cache[name]
+        self.assertEqual(migrated.status_partition, 8)
+        migrated.last_message = u'b8f70ab3cb7411e19621b88d120c81de'
+        # the status message in the old layout is no longer needed
+        self.assertEqual(worker.compact_status(), 1)
+        self.assertEqual(worker.status_partitions()[name],
+            (partition.msgid, u'b8f70ab3cb7411e19621b88d120c81de'))
+
+    def test_sqlite_store(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.checkpoint_store': 'sqlite',
+            'qdo-worker.checkpoint_path': os.path.join(tempdir, 'qdo.db'),
+        })
+        worker.configure_partitions()
+        name = queue_name + '-1'
+        worker.partition_cache[name].last_message = \
+            u'a8f70ab3cb7411e19621b88d120c81de'
+        # nothing is written to the status queue
+        self.assertEqual(worker.status_partitions(), {})
+        worker.configure_partitions()
+        self.assertEqual(worker.status,
+            {name: (None, u'a8f70ab3cb7411e19621b88d120c81de')})
+        self.assertEqual(worker.partition_cache[name].last_message,
+            u'a8f70ab3cb7411e19621b88d120c81de')
+        worker.store.close()
+
+    def test_sqlite_store_no_path(self):
+        self.assertRaises(ValueError, _make_worker, self.queuey_app_key,
+            extra={'qdo-worker.checkpoint_store': 'sqlite'}, queue=False)
+
+    def test_checkpoint_journal(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        extra = {
+            'qdo-worker.checkpoint_every_messages': 0,
+            'qdo-worker.checkpoint_journal': tempdir,
+            'qdo-worker.name': 'test',
+        }
+        worker, queue_name = self._make_one(extra=extra)
+        worker.configure_partitions()
+        name = queue_name + '-1'
+        partition = worker.partition_cache[name]
+        partition.last_message = u'a8f70ab3cb7411e19621b88d120c81de'
+        worker.flush_checkpoints()
+        partition.last_message = u'b8f70ab3cb7411e19621b88d120c81de'
+        # a crash before the next checkpoint is written
+        worker.journal.close()
+        worker, _ = self._make_one(extra=extra)
+        worker.configure_partitions()
+        self.assertEqual(worker.status[name],
+            (partition.msgid, u'b8f70ab3cb7411e19621b88d120c81de'))
+        worker.journal.close()
+
+    def test_checkpoint_journal_no_name(self):
+        self.assertRaises(ValueError, _make_worker, self.queuey_app_key,
+            extra={'qdo-worker.checkpoint_journal': '/tmp'}, queue=False)
+
     def test_work_no_job(self):
         worker, queue_name = self._make_one()
         worker.work()
@@ -190,6 +489,147 @@ class TestWorker(BaseTestCase):
         worker.work()
         self.assertEqual(counter[0], 10)
 
+    def test_work_concurrency(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.concurrency': 3})
+        queues = [queue_name] + [
+            worker.queuey_conn.create_queue() for i in range(3)]
+        for i, queue in enumerate(queues):
+            self._post_message(worker, queue,
+                ['%s-%02d' % (i, j) for j in xrange(10)])
+        lock = threading.Lock()
+        seen = []
+
+        def job(message, context):
+            with lock:
+                seen.append(message['body'])
+                if len(seen) == 40:
+                    raise StopWorker
+
+        worker.job = job
+        worker.work()
+        self.assertEqual(len(seen), 40)
+        for i in range(len(queues)):
+            bodies = [b for b in seen if b.startswith('%s-' % i)]
+            # messages of each partition are processed in order
+            self.assertEqual(bodies, sorted(bodies))
+
+    def test_work_concurrency_stop(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.concurrency': 3})
+        queues = [queue_name] + [
+            worker.queuey_conn.create_queue() for i in range(3)]
+        for i, queue in enumerate(queues):
+            self._post_message(worker, queue,
+                ['%s-%02d' % (i, j) for j in xrange(10)])
+        lock = threading.Lock()
+        seen = []
+
+        def job(message, context):
+            with lock:
+                seen.append(message['body'])
+            raise StopWorker
+
+        worker.job = job
+        worker.work()
+        # only the messages already in progress are processed
+        self.assertTrue(1 <= len(seen) <= 3)
+
+    def test_work_fetch_concurrency(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.fetch_concurrency': 4})
+        queues = [queue_name] + [
+            worker.queuey_conn.create_queue() for i in range(5)]
+        self._post_message(worker, queues[1], ['1', '2'])
+        self._post_message(worker, queues[4], ['3', 'end'])
+        seen = []
+
+        def job(message, context):
+            seen.append(message['body'])
+            if len(seen) == 4:
+                raise StopWorker
+
+        worker.job = job
+        worker.work()
+        self.assertEqual(sorted(seen), ['1', '2', '3', 'end'])
+
+    def test_work_prefetch(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.batch_size': 4,
+            'qdo-worker.prefetch_budget': 20})
+        self._post_message(worker, queue_name,
+            ['%02d' % i for i in xrange(30)])
+        seen = []
+
+        def job(message, context):
+            seen.append(message['body'])
+            if len(seen) == 30:
+                raise StopWorker
+
+        worker.job = job
+        worker.work()
+        self.assertEqual(seen, ['%02d' % i for i in xrange(30)])
+
+    def test_work_batch(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.batch_size': 5})
+        self._post_message(worker, queue_name,
+            ['%02d' % i for i in xrange(12)])
+        batches = []
+        failures = []
+
+        def job_batch(messages, context):
+            bodies = [m['body'] for m in messages]
+            batches.append(bodies)
+            if '11' in bodies:
+                raise StopWorker
+            if '02' in bodies:
+                raise ValueError('batch failed')
+            return [m['message_id'] for m in messages if m['body'] == '07']
+
+        def job_failure(message, context, name, exc, queuey_conn):
+            failures.append((message['body'], exc.__class__.__name__))
+
+        worker.job_batch = job_batch
+        worker.job_failure = job_failure
+        worker.work()
+        self.assertEqual(batches, [
+            ['00', '01', '02', '03', '04'],
+            ['05', '06', '07', '08', '09'],
+            ['10', '11'],
+        ])
+        self.assertEqual(failures, [
+            ('00', 'ValueError'), ('01', 'ValueError'),
+            ('02', 'ValueError'), ('03', 'ValueError'),
+            ('04', 'ValueError'), ('07', 'BatchFailure'),
+        ])
+        partition = worker.partition_cache[queue_name + '-1']
+        self.assertEqual(partition.last_message,
+            worker.queuey_conn.messages(queue_name, limit=10)[-1][
+                'message_id'])
+
+    def test_work_named_jobs(self):
+        queue_name = self._queuey_conn.create_queue()
+        worker, other_queue = self._make_one(extra={
+            'jobs.example.queues': [queue_name],
+            'jobs.example.job': 'qdo.testing:example_job',
+        })
+        self._post_message(worker, other_queue, 'other')
+        self._post_message(worker, queue_name, ['wait', 'stop'])
+        worker.work()
+        # only the queue with a configured job is handled
+        self.assertEqual(list(worker.partitioner), [queue_name + '-1'])
+        job = worker.jobs.get(queue_name)
+        self.assertEqual(job.name, 'example')
+        self.assertTrue(worker.jobs.get(other_queue) is None)
+
+    def test_named_jobs_invalid(self):
+        self.assertRaises(ValueError, _make_worker, self.queuey_app_key,
+            extra={'jobs.example.job': 'qdo.testing:example_job'},
+            queue=False)
+        self.assertRaises(ValueError, _make_worker, self.queuey_app_key,
+            extra={'jobs.example.queues': ['a4bb2fb6']}, queue=False)
+
     def test_job_failure_handler(self):
         worker, queue_name = self._make_one()
         context = {}
@@ -348,6 +788,36 @@ class TestKazooWorker(BaseTestCase, KazooTestHarness):
         worker.work()
         self.assertEqual([queue_name + '-1'], list(worker.partitioner))
 
+    def test_discover_partitions(self):
+        worker, queue_name = self._make_one()
+        worker.configure_partitions()
+        worker.partitioner.wait_for_acquire(5)
+        partitioner = worker.partitioner
+        new_queue = worker.queuey_conn.create_queue()
+        self.assertTrue(worker.discover_partitions())
+        # the partitioner is replaced, as its set can't be changed
+        self.assertTrue(worker.partitioner is not partitioner)
+        self.assertTrue(partitioner.failed)
+        worker.partitioner.wait_for_acquire(5)
+        self.assertEqual(sorted(worker.partitioner),
+            sorted([queue_name + '-1', new_queue + '-1']))
+        worker.stop()
+
+    def test_zookeeper_store(self):
+        worker, queue_name = self._make_one(extra={
+            'qdo-worker.checkpoint_store': 'zookeeper',
+        })
+        worker.configure_partitions()
+        name = queue_name + '-1'
+        worker.partition_cache[name].last_message = \
+            u'a8f70ab3cb7411e19621b88d120c81de'
+        self.assertEqual(worker.status_partitions(), {})
+        worker.partition_cache.clear()
+        worker.configure_partitions()
+        self.assertEqual(worker.status,
+            {name: (None, u'a8f70ab3cb7411e19621b88d120c81de')})
+        worker.stop()
+
     def test_multiple_workers(self):
         queuey_conn = self._queuey_conn
         events = []
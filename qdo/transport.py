@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sys
+import threading
+import time
+from urlparse import urljoin
+
+from queuey_py import Client
+from requests import session
+from requests.exceptions import ConnectionError
+from requests.exceptions import SSLError
+from requests.exceptions import Timeout
+import ujson
+
+from qdo.log import get_logger
+
+
+class Node(object):
+    """Tracks the health of a single Queuey server, as exponentially
+    weighted moving averages of its response time and its error rate.
+
+    :param url: The full URL of the Queuey app on this server.
+    :type url: unicode
+    :param alpha: The weight of the latest request in the moving
+        averages, defaults to 0.3.
+    :type alpha: float
+    """
+
+    def __init__(self, url, alpha=0.3):
+        self.url = url
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.ejected_until = 0
+        self.last_used = 0
+
+    def record(self, latency=None, error=False):
+        """Record the outcome of a request.
+
+        :param latency: The response time in seconds, `None` if the request
+            failed without a response.
+        :type latency: float
+        :param error: `True` if the request failed.
+        :type error: bool
+        """
+        alpha = self.alpha
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += alpha * (latency - self.latency)
+        self.error_rate += alpha * (float(error) - self.error_rate)
+
+    def healthy(self, now):
+        """Returns `True` if the node isn't ejected.
+
+        :param now: The current time.
+        :type now: float
+        :rtype: bool
+        """
+        return self.ejected_until <= now
+
+
+class PooledClient(Client):
+    """A :py:class:`Queuey client <queuey_py.Client>` keeping a pool of
+    keep-alive connections for each Queuey server, which is shared by all
+    threads of a worker.
+
+    The plain client only keeps a single connection alive, so concurrent
+    requests open a new connection each time. Requests beyond the pool
+    size still don't wait for a free connection, but their extra
+    connections are closed after use.
+
+    :param app_key: The applications key used for authorization.
+    :type app_key: str
+    :param connection: Connection information for the Queuey server.
+        Either a single full URL to the Queuey app or multiple comma
+        separated URLs.
+    :type connection: str
+    :param retries: Number of retries on connection timeouts, defaults to 3.
+    :type retries: int
+    :param timeout: Connection timeout in seconds, defaults to 5.0.
+    :type timeout: float
+    :param pool_size: Maximum number of connections kept alive for each
+        server, defaults to 1.
+    :type pool_size: int
+    :param report_interval: Minimum number of seconds between two pool
+        metric reports, defaults to 10.
+    :type report_interval: float
+    :param eject_time: Number of seconds a failing server is ejected for,
+        defaults to 30.
+    :type eject_time: float
+    :param max_error_rate: Error rate above which a server is ejected,
+        defaults to 0.5.
+    :type max_error_rate: float
+    :param probe_interval: Send a read request to a healthy server, which
+        hasn't been used for this many seconds, defaults to 10. This keeps
+        the response times of slower servers up to date.
+    :type probe_interval: float
+    """
+
+    def __init__(self, app_key,
+                 connection=u'https://127.0.0.1:5001/v1/queuey/',
+                 retries=3, timeout=5.0, pool_size=1, report_interval=10,
+                 eject_time=30, max_error_rate=0.5, probe_interval=10):
+        Client.__init__(self, app_key, connection=connection,
+            retries=retries, timeout=timeout)
+        self.pool_size = pool_size
+        self.report_interval = report_interval
+        self.eject_time = eject_time
+        self.max_error_rate = max_error_rate
+        self.probe_interval = probe_interval
+        self.nodes = [Node(url) for url in self.connection]
+        self._node_lock = threading.Lock()
+        self.session = session(headers=self.session.headers,
+            timeout=self.timeout, config={
+                u'pool_connections': len(self.connection),
+                u'pool_maxsize': pool_size,
+                u'keep_alive': True,
+            }, prefetch=True)
+        self._reported = {}
+        self._next_report = 0
+        self._lock = threading.Lock()
+
+    def select_nodes(self, read=False):
+        """Returns all servers in the order they should be tried.
+
+        Read requests go to the healthy server with the lowest response
+        time, or to a server which hasn't been used for the
+        `probe_interval`. Other requests prefer the server chosen by
+        :py:class:`queuey_py.Client`, as long as it is healthy. Ejected
+        servers are only tried last.
+
+        :param read: `True` for read requests.
+        :type read: bool
+        :rtype: list
+        """
+        now = time.time()
+        with self._node_lock:
+            healthy = [n for n in self.nodes if n.healthy(now)]
+            ejected = [n for n in self.nodes if not n.healthy(now)]
+            # servers without a response time are tried first
+            healthy.sort(key=lambda n: n.latency or 0)
+            ejected.sort(key=lambda n: n.ejected_until)
+            if read:
+                stale = [n for n in healthy
+                    if now - n.last_used >= self.probe_interval]
+                if stale:
+                    healthy.remove(stale[0])
+                    healthy.insert(0, stale[0])
+            else:
+                for node in healthy:
+                    if node.url == self.app_url:
+                        healthy.remove(node)
+                        healthy.insert(0, node)
+                        break
+            nodes = healthy + ejected
+            nodes[0].last_used = now
+        return nodes
+
+    def _record(self, node, latency=None, error=False):
+        with self._node_lock:
+            node.last_used = time.time()
+            node.record(latency=latency, error=error)
+            if error and node.error_rate > self.max_error_rate and \
+               len(self.nodes) > 1:
+                node.ejected_until = time.time() + self.eject_time
+                # start with a clean slate once the server is re-admitted
+                node.error_rate = 0.0
+                get_logger().incr('queuey.node_ejected')
+
+    def _request(self, method, url, read=False, **kwargs):
+        # Send a request to the best server, retry up to `retries` times on
+        # timeouts and try the next server on connection errors.
+        exc_info = None
+        for node in self.select_nodes(read=read):
+            full_url = urljoin(node.url, url)
+            for n in range(self.retries):
+                start = time.time()
+                try:
+                    response = getattr(self.session, method)(
+                        full_url, timeout=self.timeout, **kwargs)
+                except Timeout:
+                    exc_info = sys.exc_info()
+                    self._record(node, error=True)
+                    continue
+                except (SSLError, ConnectionError):
+                    exc_info = sys.exc_info()
+                    self._record(node, error=True)
+                    break
+                self._record(node, latency=time.time() - start,
+                    error=response.status_code >= 500)
+                return response
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def get(self, url='', params=None):
+        """Perform a GET request against the best :term:`Queuey` server.
+
+        :param url: Relative URL to get, without a leading slash.
+        :type url: str
+        :param params: Additional query string parameters.
+        :type params: dict
+        :rtype: :py:class:`requests.models.Response`
+        """
+        return self._request('get', url, read=True, params=params)
+
+    def post(self, url='', params=None, data='', headers=None):
+        """Perform a POST request against :term:`Queuey`.
+
+        :param url: Relative URL to post to, without a leading slash.
+        :type url: str
+        :param params: Additional query string parameters.
+        :type params: dict
+        :param data: The body payload, either a string for a single message
+            or a list of strings for posting multiple messages or a dict
+            for form encoded values.
+        :type data: str
+        :param headers: Additional request headers.
+        :type headers: dict
+        :rtype: :py:class:`requests.models.Response`
+        """
+        if isinstance(data, list):
+            # support message batches
+            messages = []
+            for d in data:
+                messages.append({u'body': d, u'ttl': 259200})  # three days
+            data = ujson.encode({u'messages': messages})
+            headers = {u'content-type': u'application/json'}
+        return self._request('post', url,
+            params=params, data=data, headers=headers)
+
+    def put(self, url='', params=None, data='', headers=None):
+        """Perform a PUT request against :term:`Queuey`.
+
+        :param url: Relative URL for put, without a leading slash.
+        :type url: str
+        :param params: Additional query string parameters.
+        :type params: dict
+        :param data: The body payload as a single message string.
+        :type data: str
+        :param headers: Additional request headers.
+        :type headers: dict
+        :rtype: :py:class:`requests.models.Response`
+        """
+        return self._request('put', url,
+            params=params, data=data, headers=headers)
+
+    def delete(self, url='', params=None):
+        """Perform a DELETE request against :term:`Queuey`.
+
+        :param url: Relative URL to delete, without a leading slash.
+        :type url: str
+        :param params: Additional query string parameters.
+        :type params: dict
+        :rtype: :py:class:`requests.models.Response`
+        """
+        return self._request('delete', url, params=params)
+
+    def pool_stats(self):
+        """Returns a mapping of server host and port to a tuple of the
+        number of opened connections and the number of requests sent.
+
+        :rtype: dict
+        """
+        pools = self.session.poolmanager.pools
+        stats = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats['%s:%s' % (pool.host, pool.port)] = (
+                    pool.num_connections, pool.num_requests)
+        return stats
+
+    def report(self, force=False):
+        """Send the number of connections opened and requests sent since
+        the last report as `queuey.connections` and `queuey.requests`
+        counters, if the `report_interval` has passed.
+
+        :param force: Report regardless of the `report_interval`.
+        :type force: bool
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now < self._next_report:
+                return
+            self._next_report = now + self.report_interval
+            connections = requests = 0
+            for key, value in self.pool_stats().items():
+                last = self._reported.get(key, (0, 0))
+                # a discarded and recreated pool starts counting at zero
+                if value[0] < last[0] or value[1] < last[1]:
+                    last = (0, 0)
+                connections += value[0] - last[0]
+                requests += value[1] - last[1]
+                self._reported[key] = value
+        logger = get_logger()
+        if connections:
+            logger.incr('queuey.connections', connections)
+        if requests:
+            logger.incr('queuey.requests', requests)
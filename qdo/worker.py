@@ -5,21 +5,42 @@
 
 import atexit
 from contextlib import contextmanager
+from functools import partial
 import os
 import random
 import time
 import socket
 
 from kazoo.client import KazooClient
-from queuey_py import Client
-from ujson import decode as ujson_decode
+from kazoo.exceptions import NodeExistsError
 from ujson import encode as ujson_encode
 
+from qdo.checkpoint import CheckpointWriter
 from qdo.config import ERROR_QUEUE
 from qdo.config import STATUS_PARTITIONS
 from qdo.config import STATUS_QUEUE
+from qdo.journal import CheckpointJournal
+from qdo.jobs import compile_patterns
+from qdo.jobs import Job
+from qdo.jobs import JobTable
 from qdo.partition import Partition
+from qdo.pool import JobPool
+from qdo.queues import QueueCache
+from qdo.scheduler import DeficitScheduler
+from qdo.scheduler import parse_weights
+from qdo.status import delete_status_messages
+from qdo.status import merge_status
+from qdo.status import stale_status_messages
+from qdo.status import status_messages
+from qdo.status import StatusRecords
+from qdo.store import QueueyStore
+from qdo.store import SQLiteStore
+from qdo.store import ZooKeeperStore
+from qdo.transport import PooledClient
 from qdo.log import get_logger
+from qdo.log import log_raven
+
+COMPACTION_PATH = '/status_compaction'
 
 
 @contextmanager
@@ -33,19 +54,11 @@ def dict_context():
         del context
 
 
-def _log_raven():
-    """Log exceptions using metlog-raven if it's configured."""
-    logger = get_logger()
-    raven = getattr(logger, 'raven', None)
-    if raven is not None:
-        raven()
-
-
 def log_failure(message, context, queue, exc, queuey_conn):
     """A simple job failure handler. It logs a full traceback for any failed
     job using `metlog-raven`.
     """
-    _log_raven()
+    log_raven()
 
 
 def save_failed_message(message, context, queue, exc, queuey_conn):
@@ -59,7 +72,7 @@ def save_failed_message(message, context, queue, exc, queuey_conn):
     default TTL (3 days).
     """
 
-    _log_raven()
+    log_raven()
     # record <queue>-<partition> of the failed message
     message['queue'] = queue
     try:
@@ -67,16 +80,40 @@ def save_failed_message(message, context, queue, exc, queuey_conn):
             headers={'X-TTL': '2592000'})  # thirty days
     except Exception:  # pragma: no cover
         # never fail in the failure handler itself
-        _log_raven()
+        log_raven()
+
+
+def resolve_spec(spec):
+    """Import and return the object named by a :term:`resource
+    specification`, for example `qdo.worker:dict_context`.
+    """
+    mod, func_name = spec.split(':')
+    result = __import__(mod, globals(), locals(), func_name)
+    return getattr(result, func_name)
+
+
+def job_sections(settings):
+    """Returns a mapping of job names to the settings of all
+    `[jobs:<name>]` sections. Only the explicitly configured keys are
+    included, as a settings section would also contain all defaults.
+
+    :param settings: The worker settings.
+    :type settings: :py:class:`qdo.config.QdoSettings`
+    :rtype: dict
+    """
+    prefix = 'jobs.'
+    sections = {}
+    for key, value in settings.items():
+        if key.startswith(prefix):
+            name, _, option = key[len(prefix):].partition('.')
+            sections.setdefault(name, {})[option] = value
+    return sections
 
 
 def resolve(worker, section, name):
     # resolve a resource specification and set it onto the worker
     if section[name]:
-        mod, func_name = section[name].split(':')
-        result = __import__(mod, globals(), locals(), func_name)
-        func = getattr(result, func_name)
-        setattr(worker, name, func)
+        setattr(worker, name, resolve_spec(section[name]))
 
 
 class StopWorker(Exception):
@@ -85,6 +122,12 @@ class StopWorker(Exception):
     """
 
 
+class BatchFailure(Exception):
+    """Passed to the job failure handler for each message, whose id was
+    returned as failed by a batch job. The message id is the only argument.
+    """
+
+
 class StaticPartitioner(object):
     """A partitioner using a static set list. Basic API compatibility
     with the `kazoo.recipe.SetPartitioner` is preserved.
@@ -109,6 +152,15 @@ class StaticPartitioner(object):
         self.allocating = False
         self.acquired = True
 
+    def update(self, set):
+        """Replace the set of partitions. Unlike the kazoo version, the
+        partitions don't need to be released first.
+
+        :param set: The new set of partitions.
+        :type set: tuple
+        """
+        self._set = set
+
     def release_set(self):  # pragma: no cover
         pass
 
@@ -118,16 +170,127 @@ class StaticPartitioner(object):
 
 
 class PartitionCache(dict):
+    """Creates and caches the partitions of a worker.
+
+    With a `max_size`, the cache can be trimmed down to the given number of
+    partitions, evicting the least recently active partitions first.
+    Partitions with buffered messages aren't evicted. The back-off state of
+    evicted partitions is kept, so they aren't polled any earlier than they
+    would have been otherwise.
+
+    :param worker: The worker.
+    :type worker: :py:class:`Worker`
+    :param max_size: Maximum number of cached partitions, defaults to `0`,
+        which disables the limit.
+    :type max_size: int
+    """
 
-    def __init__(self, worker):
+    def __init__(self, worker, max_size=0):
         self._worker = worker
+        self.max_size = max_size
+        self._backoff = {}
 
     def __missing__(self, key):
         worker = self._worker
+        msgid, last_message = worker.status.get(key, (None, None))
         self[key] = partition = Partition(worker.queuey_conn, key,
-            msgid=worker.status.get(key, None), worker_id=worker.name)
+            msgid=msgid, worker_id=worker.name,
+            batch_size=worker.batch_size, last_message=last_message,
+            checkpoint_every_messages=worker.checkpoint_every_messages,
+            checkpoint_every_seconds=worker.checkpoint_every_seconds,
+            writer=worker.checkpoint_writer,
+            wait_interval=worker.wait_interval,
+            records=worker.status_records,
+            status_partitions=worker.status_partition_count,
+            store=worker.store,
+            journal=worker.journal)
+        backoff = self._backoff.pop(key, None)
+        if backoff is not None:
+            partition.idle, partition.next_poll = backoff
         return partition
 
+    def due(self, key, now=None):
+        """Returns `True` if the partition has buffered messages or should
+        be polled for new messages. Evicted partitions aren't recreated for
+        this check.
+
+        :param key: The partition name.
+        :type key: str
+        :param now: The current time, defaults to :py:func:`time.time`.
+        :type now: float
+        :rtype: bool
+        """
+        partition = self.get(key)
+        if partition is not None:
+            return partition.due(now)
+        backoff = self._backoff.get(key)
+        if backoff is None:
+            return True
+        if now is None:
+            now = time.time()
+        return backoff[1] <= now
+
+    def next_poll(self, key):
+        """Returns the time at which the partition should be polled again.
+
+        :param key: The partition name.
+        :type key: str
+        :rtype: float
+        """
+        partition = self.get(key)
+        if partition is not None:
+            return partition.next_poll
+        return self._backoff.get(key, (0, 0))[1]
+
+    def evict(self, key):
+        """Flush the checkpoint of a partition and drop it, including its
+        buffered messages.
+
+        :param key: The partition name.
+        :type key: str
+        """
+        partition = self.pop(key)
+        partition.flush()
+        # recreate the partition with its current state
+        self._worker.status[key] = (partition.msgid, partition.last_message)
+        if partition.idle:
+            self._backoff[key] = (partition.idle, partition.next_poll)
+
+    def trim(self, busy=None):
+        """Evict the least recently active partitions without buffered
+        messages, until at most `max_size` partitions are cached.
+
+        :param busy: An optional function returning `True` for partitions
+            which are in use and must not be evicted.
+        :type busy: callable
+        """
+        excess = len(self) - self.max_size
+        if not self.max_size or excess <= 0:
+            return
+        candidates = [p for p in self.values()
+            if not p.buffered and not (busy and busy(p.name))]
+        candidates.sort(key=lambda p: p.last_active)
+        evicted = candidates[:excess]
+        for partition in evicted:
+            self.evict(partition.name)
+        if evicted:
+            get_logger().incr('worker.partition_evicted', len(evicted))
+
+    def discard(self, key):
+        """Evict a partition the worker no longer works on, if it is
+        cached, and forget its back-off state.
+
+        :param key: The partition name.
+        :type key: str
+        """
+        if key in self:
+            self.evict(key)
+        self._backoff.pop(key, None)
+
+    def clear(self):
+        dict.clear(self)
+        self._backoff.clear()
+
 
 class Worker(object):
     """A Worker works on jobs.
@@ -140,13 +303,31 @@ class Worker(object):
         self.settings = settings
         self.shutdown = False
         self.job = None
+        self.job_batch = None
         self.job_context = dict_context
         self.job_failure = log_failure
+        self.named_jobs = []
+        self.jobs = None
         self.partition_policy = 'manual'
+        self.include = None
+        self.exclude = None
         self.queuey_conn = None
+        self.queue_cache = None
         self.zk = None
         self.partitioner = None
+        self.partition_ids = ()
+        self.discovery_interval = 0
+        self.checkpoint_writer = None
+        self.status_records = None
+        self.store = None
+        self.journal = None
+        self.pool = None
+        self.fetch_pool = None
+        self.scheduler = None
         self.partition_cache = PartitionCache(self)
+        self._next_compaction = 0
+        self._next_discovery = 0
+        self._reload_status = False
         self.configure()
 
     def configure(self):
@@ -157,33 +338,116 @@ class Worker(object):
         if identifier:
             self.name += '-' + identifier
         self.wait_interval = qdo_section['wait_interval']
+        self.batch_size = qdo_section['batch_size']
+        self.concurrency = qdo_section['concurrency']
+        self.fetch_concurrency = qdo_section['fetch_concurrency']
+        self.prefetch_budget = qdo_section['prefetch_budget']
+        self.checkpoint_every_messages = qdo_section[
+            'checkpoint_every_messages']
+        self.checkpoint_every_seconds = qdo_section['checkpoint_every_seconds']
+        self.compact_interval = qdo_section['status_compact_interval']
+        self.partition_cache.max_size = qdo_section['partition_cache_size']
+        self.status_partition_count = qdo_section['status_partitions']
+        self.status_queue_size = self.status_partition_count
+        if qdo_section['checkpoint_async']:
+            self.checkpoint_writer = CheckpointWriter(
+                max_pending=qdo_section['checkpoint_max_pending'])
         resolve(self, qdo_section, 'job')
+        resolve(self, qdo_section, 'job_batch')
         resolve(self, qdo_section, 'job_context')
         resolve(self, qdo_section, 'job_failure')
+        self.configure_named_jobs()
+        partitions_section = self.settings.getsection('partitions')
+        self.include = compile_patterns(partitions_section['include'])
+        self.exclude = compile_patterns(partitions_section['exclude'])
+        self.scheduler = DeficitScheduler(
+            max_weight=partitions_section['max_weight'],
+            weights=parse_weights(partitions_section['weights']))
         queuey_section = self.settings.getsection('queuey')
-        self.queuey_conn = Client(
+        pool_size = queuey_section['pool_size']
+        if not pool_size:
+            # one connection for each thread talking to Queuey
+            pool_size = self.concurrency + self.fetch_concurrency
+            if self.checkpoint_writer is not None:
+                pool_size += 1
+        self.queuey_conn = PooledClient(
             queuey_section['app_key'],
-            connection=queuey_section['connection'])
+            connection=queuey_section['connection'],
+            pool_size=pool_size,
+            eject_time=queuey_section['eject_time'])
+        self.queue_cache = QueueCache(
+            self.queuey_conn, ttl=queuey_section['metadata_ttl'])
+        checkpoint_format = qdo_section['checkpoint_format']
+        if checkpoint_format == 'grouped':
+            self.status_records = StatusRecords(
+                self.queuey_conn, worker_id=self.name)
+        elif checkpoint_format != 'partition':
+            raise ValueError(
+                'Unknown checkpoint_format: %s' % checkpoint_format)
+        self.checkpoint_store = qdo_section['checkpoint_store']
+        if self.checkpoint_store not in ('queuey', 'zookeeper', 'sqlite'):
+            raise ValueError(
+                'Unknown checkpoint_store: %s' % self.checkpoint_store)
+        self.checkpoint_path = qdo_section['checkpoint_path']
+        if self.checkpoint_store == 'sqlite' and not self.checkpoint_path:
+            raise ValueError('The sqlite checkpoint_store requires a '
+                'checkpoint_path')
+        if qdo_section['checkpoint_journal']:
+            if not identifier:
+                # the journal file is named after the worker
+                raise ValueError('The checkpoint_journal requires a name')
+            self.journal = CheckpointJournal(
+                qdo_section['checkpoint_journal'], identifier,
+                sync_interval=qdo_section['checkpoint_journal_sync'])
         zk_section = self.settings.getsection('zookeeper')
         self.zk_hosts = zk_section['connection']
         self.zk_party_wait = zk_section['party_wait']
 
+    def configure_named_jobs(self):
+        # Configure the jobs from all [jobs:<name>] sections.
+        for name, section in sorted(job_sections(self.settings).items()):
+            queues = section.get('queues', [])
+            if isinstance(queues, basestring):
+                queues = [queues]
+            if not queues:
+                raise ValueError('No queues for job: %s' % name)
+            if not (section.get('job') or section.get('job_batch')):
+                raise ValueError('No job or job_batch for job: %s' % name)
+            specs = {}
+            for hook in ('job', 'job_batch', 'job_context', 'job_failure'):
+                if section.get(hook):
+                    specs[hook] = resolve_spec(section[hook])
+            self.named_jobs.append(Job(name, queues=queues, **specs))
+
+    def configure_jobs(self):
+        """Build the job table mapping queue names to jobs, based on the
+        named jobs and the worker's own job hooks.
+        """
+        default = None
+        if self.job or self.job_batch:
+            default = Job('', job=self.job, job_batch=self.job_batch,
+                job_context=self.job_context, job_failure=self.job_failure)
+        for job in self.named_jobs:
+            if job.job_context is None:
+                job.job_context = self.job_context
+            if job.job_failure is None:
+                job.job_failure = self.job_failure
+        self.jobs = JobTable(self.named_jobs, default=default)
+
     def setup_zookeeper(self):
         self.zk = KazooClient(hosts=self.zk_hosts, max_retries=1)
         self.zk.start()
 
-    def all_partitions(self):
-        # List all partitions
-        queuey_conn = self.queuey_conn
-        response = queuey_conn.get(params={'details': True})
-        queues = ujson_decode(response.text)['queues']
-        partitions = []
-        for q in queues:
-            name = q['queue_name']
-            part = q['partitions']
-            for i in xrange(1, part + 1):
-                partitions.append('%s-%s' % (name, i))
-        return partitions
+    def all_partitions(self, refresh=False):
+        """Returns the names of all partitions, as cached by the queue
+        cache.
+
+        :param refresh: List all queues, even if the cached listing hasn't
+            expired yet.
+        :type refresh: bool
+        :rtype: list
+        """
+        return self.queue_cache.partitions(refresh=refresh)
 
     def configure_partitions(self):
         section = self.settings.getsection('partitions')
@@ -191,105 +455,633 @@ class Worker(object):
         queuey_conn = self.queuey_conn
         all_partitions = self.all_partitions()
         partition_ids = section.get('ids')
-        partitioner_class = StaticPartitioner
+        # only discover new partitions if they aren't listed explicitly
+        self.discovery_interval = 0
         if not partition_ids:
-            partition_ids = all_partitions
+            partition_ids = self.filter_partitions(all_partitions)
+            self.discovery_interval = section['discovery_interval']
         if policy == 'automatic':
             self.setup_zookeeper()
-            partitioner_class = self.zk.SetPartitioner
 
+        self.configure_jobs()
+        self.partition_ids = self.select_partitions(partition_ids)
+        self.partitioner = self.create_partitioner(self.partition_ids)
+
+        if ERROR_QUEUE + '-1' not in all_partitions:
+            queuey_conn.create_queue(
+                queue_name=ERROR_QUEUE, partitions=STATUS_PARTITIONS)
+            self.queue_cache.update(ERROR_QUEUE, STATUS_PARTITIONS)
+        self.configure_status_queue(all_partitions)
+        self.configure_store()
+        self.load_status()
+        if self.journal is not None:
+            self.journal.open()
+
+    def filter_partitions(self, partition_ids):
+        """Returns the partitions of all queues matching the `include` and
+        not matching the `exclude` patterns.
+
+        :param partition_ids: Partition names.
+        :type partition_ids: list
+        :rtype: list
+        """
+        include = self.include
+        exclude = self.exclude
+        if include is None and exclude is None:
+            return partition_ids
+        result = []
+        for name in partition_ids:
+            queue_name = name.split('-')[0]
+            if include is not None and not include.match(queue_name):
+                continue
+            if exclude is not None and exclude.match(queue_name):
+                continue
+            result.append(name)
+        return result
+
+    def select_partitions(self, partition_ids):
+        """Returns the partitions the worker should work on, excluding the
+        error and status queues.
+
+        :param partition_ids: Partition names.
+        :type partition_ids: list
+        :rtype: tuple
+        """
         partition_ids = [p for p in partition_ids if not
             p.startswith((ERROR_QUEUE, STATUS_QUEUE))]
+        if self.jobs.jobs:
+            # resolve the job for each queue once and only take partitions
+            # of queues some job is configured for
+            partition_ids = [p for p in partition_ids
+                if self.jobs.get(p.split('-')[0]) is not None]
+        return tuple(partition_ids)
+
+    def create_partitioner(self, partition_ids):
+        """Create a partitioner for the given partitions, as configured by
+        the partition policy.
 
-        self.partitioner = partitioner_class(
-            '/worker', set=tuple(partition_ids), identifier=self.name,
+        :param partition_ids: Partition names.
+        :type partition_ids: tuple
+        """
+        partitioner_class = StaticPartitioner
+        if self.partition_policy == 'automatic':
+            partitioner_class = self.zk.SetPartitioner
+        return partitioner_class(
+            '/worker', set=partition_ids, identifier=self.name,
             time_boundary=self.zk_party_wait)
 
-        def cond_create(queue_name):
-            if queue_name + '-1' not in all_partitions:
-                queuey_conn.create_queue(
-                    queue_name=queue_name, partitions=STATUS_PARTITIONS)
-        cond_create(ERROR_QUEUE)
-        cond_create(STATUS_QUEUE)
-        self.status = self.status_partitions()
+    def discover_partitions(self):
+        """List all partitions again and apply the added and removed
+        partitions to the partitioner. Returns `True` if the partitions
+        changed.
+
+        The static partitioner is updated in place. The kazoo partitioner
+        can't change its set, so the worker releases its partitions and
+        joins the party again with the new set, causing a rebalance.
+
+        If the partitions can't be listed, the error is logged and the
+        worker keeps working on the known partitions.
+
+        :rtype: bool
+        """
+        current = self.partition_ids
+        try:
+            all_partitions = self.all_partitions()
+        except Exception:
+            log_raven()
+            return False
+        partition_ids = self.select_partitions(
+            self.filter_partitions(all_partitions))
+        new = set(partition_ids)
+        old = set(current)
+        # keep the existing order and append new partitions
+        added = [p for p in partition_ids if p not in old]
+        removed = [p for p in current if p not in new]
+        if not (added or removed):
+            return False
+        logger = get_logger()
+        logger.incr('worker.partitions_added', len(added))
+        logger.incr('worker.partitions_removed', len(removed))
+        self.partition_ids = tuple(
+            [p for p in current if p in new] + added)
+        partitioner = self.partitioner
+        if isinstance(partitioner, StaticPartitioner):
+            if removed:
+                self.join_pools()
+            for name in removed:
+                self.partition_cache.discard(name)
+                self.scheduler.discard(name)
+            partitioner.update(self.partition_ids)
+        else:
+            self.release_partitions()
+            partitioner.finish()
+            self.partitioner = self.create_partitioner(self.partition_ids)
+        return True
+
+    def maybe_discover_partitions(self):
+        """Discover new and removed partitions, if the
+        `discovery_interval` has passed since the last discovery.
+        """
+        now = time.time()
+        if now < self._next_discovery:
+            return
+        self._next_discovery = now + self.discovery_interval
+        self.discover_partitions()
+
+    def load_status(self):
+        """Load the checkpoints of all partitions from the checkpoint store
+        and the journal.
+        """
+        status = self.store.load()
+        if self.journal is not None:
+            # take the newer of the stored and the journaled checkpoint
+            for name, processed in self.journal.load().items():
+                merge_status(status, name, None, processed)
+        self.status = status
+
+    def configure_store(self):
+        """Create the checkpoint store, as configured by the
+        `checkpoint_store` setting.
+        """
+        if self.store is not None:
+            self.store.close()
+        if self.checkpoint_store == 'queuey':
+            self.store = QueueyStore(self)
+            return
+        # status records are specific to the status queue
+        self.status_records = None
+        if self.checkpoint_store == 'zookeeper':
+            if self.zk is None:
+                self.setup_zookeeper()
+            self.store = ZooKeeperStore(
+                self.zk, path=self.checkpoint_path or '/checkpoints')
+        else:
+            self.store = SQLiteStore(self.checkpoint_path)
+
+    def configure_status_queue(self, all_partitions):
+        """Create the status queue or add partitions to it, if it has fewer
+        than the configured number of status partitions.
+
+        Status messages written with a different number of status
+        partitions stay where they are and are still read, so changing the
+        number doesn't lose any processing state. Checkpoints are written
+        using the new layout and the old status messages are removed by the
+        status compaction.
+
+        :param all_partitions: Names of all partitions.
+        :type all_partitions: list
+        """
+        prefix = STATUS_QUEUE + '-'
+        size = len([p for p in all_partitions if p.startswith(prefix)])
+        count = self.status_partition_count
+        if not size:
+            self.queuey_conn.create_queue(
+                queue_name=STATUS_QUEUE, partitions=count)
+            self.queue_cache.update(STATUS_QUEUE, count)
+        elif size < count:
+            # Queuey can only ever add partitions to an existing queue
+            self.queuey_conn.put(STATUS_QUEUE, data={'partitions': count})
+            self.queue_cache.update(STATUS_QUEUE, count)
+        self.status_queue_size = max(size, count)
 
-    def status_partitions(self):
+    def status_partitions(self, page_size=1000):
+        """Returns a mapping of partition names to a tuple of the status
+        message id and the id of the last processed message.
+
+        All status partitions are read page by page, in parallel if the
+        `fetch_concurrency` allows it. Both status messages of single
+        partitions and grouped status records are read. If there are
+        multiple entries for a partition, the newest processed message id
+        wins. The status message id is `None` for partitions only found in
+        grouped status records.
+
+        :param page_size: Number of status messages read per request.
+        :type page_size: int
+        :rtype: dict
+        """
+        results = {}
+
+        def read(context, status_partition):
+            results[status_partition] = self._read_status_partition(
+                status_partition, page_size)
+
+        status_partitions = range(1, self.status_queue_size + 1)
+        size = min(self.fetch_concurrency, self.status_queue_size)
+        if size > 1:
+            pool = JobPool(size, dict_context)
+            pool.start()
+            for status_partition in status_partitions:
+                pool.submit(status_partition,
+                    partial(read, status_partition=status_partition))
+            pool.stop()
+        else:
+            for status_partition in status_partitions:
+                read(None, status_partition)
         status = {}
-        # get all status messages, starting with the newest ones
-        status_messages = self.queuey_conn.messages(
-            STATUS_QUEUE, limit=1000, order='descending')
-        if len(status_messages) >= 1000:  # pragma: no cover
-            # TODO deal with more than 1000 status messages / partitions
-            raise RuntimeError('More than 1000 status messages detected!')
-        for message in status_messages:
-            body = ujson_decode(message['body'])
-            partition = body['partition']
-            if partition not in status:
-                # don't overwrite newer messages with older status
-                status[partition] = message['message_id']
+        # with a changed number of status partitions, a partition can have
+        # status messages in more than one status partition
+        for status_partition in status_partitions:
+            for name, (msgid, processed) in \
+                    results[status_partition].items():
+                merge_status(status, name, msgid, processed)
         return status
 
+    def _read_status_partition(self, status_partition, page_size):
+        status = {}
+        for message_id, body in status_messages(
+                self.queuey_conn, status_partition, page_size):
+            if 'partitions' in body:
+                # a grouped status record
+                for name, processed in body['partitions'].items():
+                    merge_status(status, name, None, processed)
+            else:
+                merge_status(status, body['partition'], message_id,
+                    body['processed'])
+        return status
+
+    def compact_status(self, page_size=1000):
+        """Delete all status messages of partitions which no longer exist
+        and all but the newest status message of every other partition.
+
+        :param page_size: Number of status messages read per request.
+        :type page_size: int
+        :returns: The number of deleted status messages.
+        :rtype: int
+        """
+        entries = []
+        for status_partition in xrange(1, self.status_queue_size + 1):
+            for message_id, body in status_messages(
+                    self.queuey_conn, status_partition, page_size):
+                entries.append((status_partition, message_id, body))
+        # list the partitions last and bypass the queue cache, so status
+        # messages of partitions created in the meantime are kept
+        partitions = set(self.all_partitions(refresh=True))
+        stale = stale_status_messages(entries, partitions,
+            status_partitions=self.status_partition_count)
+        delete_status_messages(self.queuey_conn, stale)
+        get_logger().incr('worker.status_compacted', len(stale))
+        return len(stale)
+
+    def maybe_compact_status(self):
+        """Compact the status queue, if the `status_compact_interval` has
+        passed since the last compaction. With the automatic partition
+        policy, the workers coordinate via ZooKeeper, so only one of them
+        compacts the status queue once per interval.
+        """
+        now = time.time()
+        if now < self._next_compaction:
+            return
+        self._next_compaction = now + self.compact_interval
+        try:
+            if self.zk is None:
+                self.compact_status()
+                return
+            zk = self.zk
+            zk.ensure_path(COMPACTION_PATH)
+            last, stat = zk.get(COMPACTION_PATH)
+            if last and now - float(last) < self.compact_interval:
+                return
+            try:
+                zk.create(COMPACTION_PATH + '/lock', self.name,
+                    ephemeral=True)
+            except NodeExistsError:
+                # another worker is compacting right now
+                return
+            try:
+                self.compact_status()
+                zk.set(COMPACTION_PATH, str(time.time()))
+            finally:
+                zk.delete(COMPACTION_PATH + '/lock')
+        except Exception:
+            # compaction is best effort, never stop working on jobs
+            log_raven()
+
+    def process(self, job, partition, message, context):
+        """Process a single message of a partition and record it as
+        processed. A :py:exc:`StopWorker` exception raised by the job shuts
+        down the worker, leaving the message unprocessed.
+
+        :param job: The job for the partition's queue.
+        :type job: :py:class:`qdo.jobs.Job`
+        :param partition: The partition the message belongs to.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :param message: The message.
+        :type message: dict
+        :param context: The job context.
+        """
+        timer = get_logger().timer
+        try:
+            with timer('worker.job_time'):
+                job.job(message, context)
+        except StopWorker:
+            self.shutdown = True
+            return
+        except Exception as exc:
+            with timer('worker.job_failure_time'):
+                job.job_failure(message, context,
+                    partition.name, exc, self.queuey_conn)
+        # record successful message processing
+        partition.last_message = message['message_id']
+
+    def process_batch(self, job, partition, messages, context):
+        """Process a list of messages of a partition with the batch job and
+        record all of them as processed.
+
+        If the batch job raises an exception, the job failure handler is
+        called for each message. The batch job can also return the message
+        ids of only some failed messages, in which case the job failure
+        handler is called for these messages with a :py:exc:`BatchFailure`.
+        A :py:exc:`StopWorker` exception shuts down the worker, leaving all
+        messages unprocessed.
+
+        :param job: The job for the partition's queue.
+        :type job: :py:class:`qdo.jobs.Job`
+        :param partition: The partition the messages belong to.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :param messages: The messages.
+        :type messages: list
+        :param context: The job context.
+        """
+        timer = get_logger().timer
+        try:
+            with timer('worker.job_batch_time'):
+                failed = job.job_batch(messages, context)
+        except StopWorker:
+            self.shutdown = True
+            return
+        except Exception as exc:
+            with timer('worker.job_failure_time'):
+                for message in messages:
+                    job.job_failure(message, context,
+                        partition.name, exc, self.queuey_conn)
+        else:
+            if failed:
+                failed = set(failed)
+                with timer('worker.job_failure_time'):
+                    for message in messages:
+                        message_id = message['message_id']
+                        if message_id in failed:
+                            job.job_failure(message, context,
+                                partition.name, BatchFailure(message_id),
+                                self.queuey_conn)
+        # record successful processing of the entire batch
+        partition.last_message = messages[-1]['message_id']
+
+    def process_messages(self, partition, message, limit, contexts):
+        """Process up to `limit` messages of a partition, starting with the
+        given message and continuing with its buffered messages. The
+        scheduler is charged for the processed messages. With a batch job,
+        up to `limit` batches of buffered messages are processed instead.
+        The job is looked up in the job table by the partition's queue name.
+
+        :param partition: The partition the messages belong to.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :param message: The first message.
+        :type message: dict
+        :param limit: Maximum number of messages to process.
+        :type limit: int
+        :param contexts: A mapping of job names to job contexts.
+        :type contexts: dict
+        """
+        if self.shutdown:
+            # a task queued before a job raised StopWorker
+            return
+        job = self.jobs.get(partition.queue_name)
+        context = contexts[job.name]
+        processed = 0
+        while message is not None:
+            if job.job_batch is None:
+                self.process(job, partition, message, context)
+            else:
+                messages = [message] + partition.next_messages(
+                    self.batch_size - 1)
+                self.process_batch(job, partition, messages, context)
+            processed += 1
+            if self.shutdown or processed >= limit:
+                break
+            message = partition.next_message(fetch=False)
+        self.scheduler.charge(partition, processed)
+
     def work(self):
         """Work on jobs."""
-        if not self.job:
+        if not (self.job or self.job_batch or self.named_jobs):
             return
         # Try Queuey heartbeat connection
         self.queuey_conn.connect()
         self.configure_partitions()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.start()
         atexit.register(self.stop)
-        timer = get_logger().timer
-        partitioner = self.partitioner
-        with self.job_context() as context:
-            if partitioner.allocating:
+        self._next_compaction = time.time() + self.compact_interval
+        self._next_discovery = time.time() + self.discovery_interval
+        if self.fetch_concurrency > 1 or self.prefetch_budget:
+            self.fetch_pool = JobPool(self.fetch_concurrency, dict_context)
+            self.fetch_pool.start()
+        try:
+            if self.concurrency > 1:
+                self.pool = JobPool(self.concurrency, self.jobs.contexts)
+                self.pool.start()
+                try:
+                    self._work(None)
+                finally:
+                    self.pool.stop()
+            else:
+                with self.jobs.contexts() as contexts:
+                    self._work(contexts)
+        finally:
+            if self.fetch_pool is not None:
+                self.fetch_pool.stop()
+        # give up the partitions and leave party
+        self.flush_checkpoints()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.stop()
+        self.store.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.queuey_conn.report(force=True)
+        self.partitioner.finish()
+
+    def _work(self, contexts):
+        pool = self.pool
+        fetch_pool = self.fetch_pool
+        scheduler = self.scheduler
+        cache = self.partition_cache
+
+        def busy(name):
+            return (pool is not None and pool.busy(name)) or \
+                (fetch_pool is not None and fetch_pool.busy(name))
+
+        if self.partitioner.allocating:
+            self.partitioner.wait_for_acquire(self.zk_party_wait)
+        while 1:
+            # partition discovery might replace the partitioner
+            partitioner = self.partitioner
+            if self.shutdown or partitioner.failed:
+                break
+            if partitioner.release:
+                self.release_partitions()
+                partitioner.release_set()
+            elif partitioner.allocating:
                 partitioner.wait_for_acquire(self.zk_party_wait)
-            waited = 0
-            while 1:
-                if self.shutdown or partitioner.failed:
-                    break
-                if partitioner.release:
-                    partitioner.release_set()
-                elif partitioner.allocating:
-                    partitioner.wait_for_acquire(self.zk_party_wait)
-                elif partitioner.acquired:
-                    no_messages = 0
-                    partitions = list(self.partitioner)
-                    for name in partitions:
-                        partition = self.partition_cache[name]
-                        messages = partition.messages(limit=2)
-                        if not messages:
-                            no_messages += 1
+            elif partitioner.acquired:
+                if self._reload_status:
+                    self._reload_status = False
+                    self.load_status()
+                if self.compact_interval:
+                    self.maybe_compact_status()
+                if self.discovery_interval:
+                    self.maybe_discover_partitions()
+                    if self.partitioner is not partitioner:
+                        continue
+                self.queuey_conn.report()
+                dispatched = deferred = 0
+                names = list(partitioner)
+                if fetch_pool is not None:
+                    self.fetch_partitions(names)
+                    if self.prefetch_budget:
+                        self.prefetch_partitions(names)
+                now = time.time()
+                for name in names:
+                    if pool is not None and pool.busy(name):
+                        # keep the messages of each partition in order
+                        continue
+                    if name not in cache and not cache.due(name, now):
+                        # an evicted partition, which is backing off
+                        continue
+                    partition = cache[name]
+                    message = None
+                    if partition.due(now):
+                        limit = scheduler.credit(partition)
+                        if not limit:
+                            # save up credit for one of the next passes
+                            deferred += 1
                             continue
-                        message = messages[0]
-                        message_id = message['message_id']
-                        try:
-                            with timer('worker.job_time'):
-                                self.job(message, context)
-                        except StopWorker:
-                            self.shutdown = True
+                        message = partition.next_message(
+                            fetch=fetch_pool is None)
+                    if message is None:
+                        scheduler.charge(partition, 0)
+                        # honor the time based checkpoint limit
+                        partition.flush(force=False)
+                        continue
+                    dispatched += 1
+                    if pool is None:
+                        self.process_messages(
+                            partition, message, limit, contexts)
+                        if self.shutdown:
                             break
-                        except Exception as exc:
-                            with timer('worker.job_failure_time'):
-                                self.job_failure(message, context,
-                                    name, exc, self.queuey_conn)
-                        # record successful message processing
-                        partition.last_message = message_id
-                    if no_messages == len(partitions):
-                        # if none of the partitions had a message, wait
-                        self.wait(waited)
-                        waited += 1
                     else:
-                        waited = 0
-            # give up the partitions and leave party
-            self.partitioner.finish()
+                        pool.submit(name, partial(self.process_messages,
+                            partition, message, limit))
+                if cache.max_size:
+                    cache.trim(busy)
+                if dispatched or deferred:
+                    continue
+                if pool is not None and pool.active:
+                    # all partitions with messages are busy
+                    pool.wait(self.wait_interval)
+                else:
+                    # if none of the partitions had a message, wait
+                    self.flush_checkpoints()
+                    self.wait(names)
 
-    def wait(self, waited=1):
+    def fetch_partitions(self, names):
+        """Fetch new messages for all partitions without buffered messages
+        in parallel, using the fetch thread pool.
+
+        :param names: Partition names.
+        :type names: list
+        """
+        fetch_pool = self.fetch_pool
+        for name in names:
+            if self.pool is not None and self.pool.busy(name):
+                continue
+            if fetch_pool.busy(name):
+                # already being prefetched
+                continue
+            if not self.partition_cache.due(name):
+                continue
+            partition = self.partition_cache[name]
+            fetch_pool.submit(name,
+                lambda context, partition=partition: partition.fetch())
+        fetch_pool.join()
+
+    def prefetch_partitions(self, names):
+        """Fetch the next batch of messages in the background, for all
+        partitions which are running low on buffered messages. The total
+        number of buffered and requested messages is limited by the
+        `prefetch_budget`.
+
+        :param names: Partition names.
+        :type names: list
+        """
+        fetch_pool = self.fetch_pool
+        batch = self.batch_size + 1
+        low_water = self.batch_size // 2
+        budget = self.prefetch_budget - fetch_pool.active * batch - sum(
+            p.buffered for p in self.partition_cache.values())
+        for name in names:
+            if budget < batch:
+                get_logger().incr('worker.prefetch_budget_exhausted')
+                break
+            partition = self.partition_cache.get(name)
+            if partition is None or fetch_pool.busy(name):
+                continue
+            if 0 < partition.buffered <= low_water:
+                fetch_pool.submit(name, lambda context, partition=partition:
+                    partition.fetch(low_water))
+                budget -= batch
+
+    def wait(self, names):
+        """Wait until the first of the given partitions should be polled
+        again. Without any partitions, wait for the `wait_interval`.
+
+        :param names: Partition names.
+        :type names: list
+        """
         get_logger().incr('worker.wait_for_jobs')
-        jitter = random.uniform(0.8, 1.2)
-        time.sleep(self.wait_interval * jitter * 2 ** min(waited, 10))
+        if names:
+            next_poll = min(
+                self.partition_cache.next_poll(name) for name in names)
+            seconds = next_poll - time.time()
+        else:
+            seconds = self.wait_interval * random.uniform(0.8, 1.2)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def join_pools(self):
+        """Wait for all running jobs and fetches to finish."""
+        if self.pool is not None:
+            self.pool.join()
+        if self.fetch_pool is not None:
+            self.fetch_pool.join()
+
+    def release_partitions(self):
+        """Flush the checkpoints of all partitions and drop them, including
+        their buffered messages.
+        """
+        self.join_pools()
+        for name in self.partition_cache.keys():
+            self.partition_cache.evict(name)
+        self.partition_cache.clear()
+        self.flush_checkpoints()
+        self.scheduler.clear()
+        # other workers might have processed some of the partitions by the
+        # time they are acquired again
+        self._reload_status = True
+
+    def flush_checkpoints(self):
+        """Write all pending checkpoints to the checkpoint store."""
+        if self.journal is not None:
+            self.journal.sync()
+        for partition in self.partition_cache.values():
+            partition.flush()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
 
     def stop(self):
         """Stop the worker loop. Used in an `atexit` hook."""
         self.shutdown = True
+        self.flush_checkpoints()
         if self.zk is not None:
             self.partitioner.finish()
             self.zk.stop()
@@ -298,3 +1090,13 @@ class Worker(object):
 def run(settings):  # pragma: no cover
     worker = Worker(settings)
     worker.work()
+
+
+def compact(settings):
+    """Compact the status queue once and return the number of deleted
+    status messages.
+    """
+    worker = Worker(settings)
+    worker.queuey_conn.connect()
+    worker.configure_status_queue(worker.all_partitions())
+    return worker.compact_status()